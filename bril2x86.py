@@ -1,270 +1,204 @@
+import argparse
 import json
+import os
+import struct
 import sys
 
+from collections import Counter
 from dataclasses import dataclass
 
+from cfg import CFG
+from inline import inline_program
+from layout import layout
+from parse import parse_program
+from passes import Hook, PassManager, PassStats
+from peephole import peephole
+from regalloc import (
+    CALL_OPS,
+    Allocation,
+    is_reg,
+    register_allocation,
+    stack_allocation,
+)
+from sccp import constant_vars, fold, sccp
+from server import default_socket, serve_socket, serve_stream
+from ssa import optimize
+from strength import div_by_constant, mul_by_constant
+from x86 import (
+    Instruction,
+    Label,
+    Jump,
+    JumpCond,
+    Mov,
+    Cmov,
+    Push,
+    Pop,
+    Ret,
+    Neg,
+    Not,
+    Xor,
+    Add,
+    Sub,
+    Mul,
+    Cmp,
+    Test,
+    Unary,
+    Binary,
+    Call,
+    TailCall,
+    Div,
+    And,
+    Or,
+    Sar,
+    Shl,
+    Shr,
+    Lea,
+    Addsd,
+    Subsd,
+    Mulsd,
+    Divsd,
+    Ucomisd,
+    AllocateStack,
+    DeallocateStack,
+    Cqo,
+    Function,
+    Program,
+    XOR,
+    ADD,
+    SUB,
+    MUL,
+    DIV,
+    AND,
+    OR,
+    CMP,
+    TEST,
+    ADDSD,
+    SUBSD,
+    MULSD,
+    DIVSD,
+    UCOMISD,
+    set_cc,
+    immediate,
+    memory,
+    stack_slot,
+)
+
 device = "mac"
 assert device in ["mac", "linux"]
 
 debug_mode = False
 
-
-@dataclass
-class Instruction:
-    pass
-
-
-@dataclass
-class Label(Instruction):
-    name: str
-
-
-@dataclass
-class Jump(Instruction):
-    target: int
-
-
-@dataclass
-class JumpCond(Instruction):
-    cond_code: str
-    label: str
-
-
-@dataclass
-class Mov(Instruction):
-    t: str
-    src: str
-    dest: str
-
-
-@dataclass
-class Push(Instruction):
-    t: str
-    reg: str
-
-
-@dataclass
-class Pop(Instruction):
-    t: str
-    reg: str
+# bytes of assembly collected before each write to an -o file
+OUTPUT_BUFFER = 1 << 16
 
 
 @dataclass
-class Ret(Instruction):
-    pass
-
-
-@dataclass
-class Operator:
-    pass
-
-
-@dataclass
-class Neg(Operator):
-    pass
-
-
-@dataclass
-class Not(Operator):
-    pass
-
-
-@dataclass
-class Xor(Operator):
-    pass
-
-
-@dataclass
-class Add(Operator):
-    pass
-
-
-@dataclass
-class Sub(Operator):
-    pass
-
-
-@dataclass
-class Mul(Operator):
-    pass
-
-
-@dataclass
-class Cmp(Operator):
-    pass
-
-
-@dataclass
-class Set(Operator):
-    code: str
-
-
-@dataclass
-class Test(Operator):
-    pass
-
-
-@dataclass
-class Operand:
-    pass
-
-
-@dataclass
-class Reg:
-    name: str
-
-
-@dataclass
-class Unary(Instruction):
-    unary_operator: Operator
-    operand: str
-
-
-@dataclass
-class Binary(Instruction):
-    binary_operator: str
-    src: str
-    dest: str
-
-
-@dataclass
-class Call(Instruction):
-    t: str
-    name: str
-
-
-@dataclass
-class Print(Instruction):
-    args: list[str]
-    types: list[str]
-
-
-@dataclass
-class Imm(Operand):
-    val: int
-
-
-@dataclass
-class Pseudo:
-    identifier: str
-
-
-@dataclass
-class Div(Operator):
-    pass
-
-
-@dataclass
-class And(Operator):
-    pass
-
-
-@dataclass
-class Or(Operator):
-    pass
-
-
-@dataclass
-class AllocateStack(Instruction):
-    num: int
-
-
-@dataclass
-class Stack(Operand):
-    num: int
-
-
-@dataclass
-class Cqo(Instruction):
-    pass
-
-
-def format_operand(operand: Operand) -> str:
-    match operand:
-        case Reg(name):
-            reg_mapping = {
-                "AX": "%eax",
-                "DX": "%edx",
-                "R10": "%r10d",
-                "R11": "%r11d",
-            }
-            assert name in reg_mapping
-            return reg_mapping[name]
-        case Stack(num):
-            return f"{num}(%rsp)"
-        case Imm(num):
-            return f"${num}"
-
-
-def format_operator(operator):
-    match operator:
-        case Neg():
-            return "negq"
-        case Not():
-            return "notq"
-        case Xor():
-            return "xorq"
-        case Add():
-            return "addq"
-        case Sub():
-            return "subq"
-        case Mul():
-            return "imulq"
-        case Div():
-            return "idivq"
-        case And():
-            return "andq"
-        case Or():
-            return "orq"
-        case Cmp():
-            return "cmpq"
-        case Set(code):
-            return f"set{code}"
-        case Test():
-            return "testq"
-
-
-def format_instruction(construct):
-    assert isinstance(construct, Instruction)
-    match construct:
-        case Mov(t, src, dest):
-            return [f"mov{t} {src}, {dest}"]
-        case Push(t, reg):
-            return [f"push{t} {reg}"]
-        case Pop(t, reg):
-            return [f"pop{t} {reg}"]
-        case Ret():
-            # return ["movq %rbp, %rsp", "popq %rbp", "retq"]
-            return ["retq"]
-        case Unary(operator, operand):
-            return [f"{format_operator(operator)} {operand}"]
-        case Binary(operator, src, dest):
-            return [f"{format_operator(operator)} {src}, {dest}"]
-        case AllocateStack(num):
-            return [f"subq ${num}, %rsp"]
-        case Call(t, name):
-            if name == "main":
-                name = "main_main"
-            return [f"call{t} _{name}"]
-        case Label(name):
-            name = "_" + name.replace(".", "_")
-            return [f"{name}:"]
-        case Jump(label):
-            label = "_" + label.replace(".", "_")
-            return [f"jmp {label}"]
-        case JumpCond(cond_code, label):
-            label = "_" + label.replace(".", "_")
-            return [f"j{cond_code} {label}"]
-        case Cqo():
-            return ["cqo"]
-
-    raise NotImplementedError(f"Unknown instruction: {construct}")
-
-
-@dataclass
-class Function:
-    name: str
-    instructions: list[Instruction]
+class Options:
+    # allocate variables to registers; otherwise every variable lives in its
+    # own stack slot, which is handy when debugging generated code
+    regalloc: bool = True
+    # inline calls to non-recursive functions of at most this many
+    # instructions; 0 turns inlining off
+    inline_threshold: int = 20
+    # print what was inlined and how the program grew to stderr
+    inline_report: bool = False
+    # fold constants and prune constant branches before lowering
+    sccp: bool = True
+    # go through SSA for value numbering and dead code elimination
+    ssa: bool = True
+    # turn small branch diamonds into straight-line code and cmov
+    if_conversion: bool = True
+    # hoist loop-invariant code and turn multiplies by induction variables
+    # into additions; needs ssa
+    loop_opts: bool = True
+    # copies of the body per test when unrolling counted loops; 1 only
+    # unrolls loops with small constant trip counts, fully
+    unroll_factor: int = 4
+    # instructions unrolling may add to a function; 0 turns it off
+    unroll_budget: int = 256
+    # print each function's IR to stderr after every stage
+    dump_ir: bool = False
+    # thread jumps and order blocks so likely successors fall through
+    layout: bool = True
+    # turn calls whose result is returned right away into jumps
+    tail_calls: bool = True
+    # lower mul and div by constants to shifts, lea and magic multiplies
+    strength_reduction: bool = True
+    # allocate through the size-class arena in rt.c instead of malloc
+    arena: bool = True
+    # let stack values with disjoint lifetimes share a slot
+    share_slots: bool = True
+    # print per-function frame sizes before and after slot sharing to stderr
+    report_frames: bool = False
+    # clean up the emitted instructions with the rules in peephole.py
+    peephole: bool = True
+    # print how often each peephole rule fired to stderr
+    peephole_stats: bool = False
+
+
+# mnemonic of each operator type; setCC is named by its condition code
+operator_names = {
+    Neg: "negq",
+    Not: "notq",
+    Xor: "xorq",
+    Add: "addq",
+    Sub: "subq",
+    Mul: "imulq",
+    Div: "idivq",
+    And: "andq",
+    Or: "orq",
+    Sar: "sarq",
+    Shl: "shlq",
+    Shr: "shrq",
+    Cmp: "cmpq",
+    Test: "testq",
+    Addsd: "addsd",
+    Subsd: "subsd",
+    Mulsd: "mulsd",
+    Divsd: "divsd",
+    Ucomisd: "ucomisd",
+}
+
+
+def format_operator(operator) -> str:
+    name = operator_names.get(type(operator))
+    return name if name is not None else f"set{operator.code}"
+
+
+def label_name(label: str) -> str:
+    return "_" + label.replace(".", "_")
+
+
+def function_name(name: str) -> str:
+    return "_main_main" if name == "main" else f"_{name}"
+
+
+# how each instruction type is written out, looked up by type
+instruction_formats = {
+    Mov: lambda i: f"mov{i.t} {i.src}, {i.dest}",
+    Push: lambda i: f"push{i.t} {i.reg}",
+    Pop: lambda i: f"pop{i.t} {i.reg}",
+    Ret: lambda i: "retq",
+    Unary: lambda i: f"{format_operator(i.unary_operator)} {i.operand}",
+    Binary: lambda i: f"{format_operator(i.binary_operator)} {i.src}, {i.dest}",
+    Cmov: lambda i: f"cmov{i.cond_code}q {i.src}, {i.dest}",
+    Lea: lambda i: f"leaq {i.src}, {i.dest}",
+    AllocateStack: lambda i: f"subq ${i.num}, %rsp",
+    DeallocateStack: lambda i: f"addq ${i.num}, %rsp",
+    Call: lambda i: f"call{i.t} {function_name(i.name)}",
+    TailCall: lambda i: f"jmp {function_name(i.name)}",
+    Label: lambda i: f"{label_name(i.name)}:",
+    Jump: lambda i: f"jmp {label_name(i.target)}",
+    JumpCond: lambda i: f"j{i.cond_code} {label_name(i.label)}",
+    Cqo: lambda i: "cqo",
+}
+
+
+def format_instruction(construct: Instruction) -> str:
+    fmt = instruction_formats.get(type(construct))
+    if fmt is None:
+        raise NotImplementedError(f"Unknown instruction: {construct}")
+    return fmt(construct)
 
 
 def format_function(f: Function) -> list[str]:
@@ -274,263 +208,722 @@ def format_function(f: Function) -> list[str]:
         ".p2align	4, 0x90",
         f"_{f.name}:",
     ]
-    for instruction in f.instructions:
-        output.extend(format_instruction(instruction))
-
-    output.append("movq %rbp, %rsp")
-    output.append("xorq %rax, %rax")
-    output.append("popq %rbp")
-    output.append("retq")
+    output.extend(map(format_instruction, f.instructions))
 
     return output
 
 
-@dataclass
-class Program:
-    functions: list[Function]
-
+def format_header() -> list[str]:
+    if device == "linux":
+        return ['.section .note.GNU-stack,"",@progbits']
+    return [
+        ".section	__TEXT,__text,regular,pure_instructions",
+        ".build_version macos, 15, 0	sdk_version 15, 2",
+    ]
 
-def format_program(prog: Program):
 
+def format_trailer(literals: dict) -> list[str]:
+    """Everything after the last function: the float literal pool."""
     output = []
-    if device == "linux":
-        output.append('.section .note.GNU-stack,"",@progbits')
-    elif device == "mac":
-        output.extend(
-            [
-                ".section	__TEXT,__text,regular,pure_instructions",
-                ".build_version macos, 15, 0	sdk_version 15, 2",
-            ]
-        )
-
-    for f in prog.functions:
-        output.extend(format_function(f))
+    if literals:
+        if device == "mac":
+            output.append(".section	__TEXT,__literal8,8byte_literals")
+        else:
+            output.append(".section .rodata")
+        output.append(".p2align	3")
+        for bits, label in literals.items():
+            output.extend([f"_{label}:", f".quad {bits:#018x}"])
 
     output.append(".subsections_via_symbols")
     return output
 
 
-def fake_main_to_assembly(func):
-    lines = []
-    lines.append(Push("q", "%rbp"))
-    lines.append(Mov("q", "%rsp", "%rbp"))
-
-    if "args" in func and len(func["args"]) > 0:
-
-        arg_regs = ["%rdi", "%rsi", "%rdx", "%rcx", "%r8", "%r9"]
-
-        if func.get("args", []):
-            args = func["args"]
-            var_count = len(args)
-
-            stack_bytes = (var_count + 1) * 8
-            if stack_bytes > 0:
-                lines.append(AllocateStack(stack_bytes))
-                lines.append(Mov("q", "%rbx", f"{var_count * 8}(%rsp)"))
-                lines.append(Mov("q", "%rsi", "%rbx"))
+def format_program(prog: Program):
+    output = format_header()
+    for f in prog.functions:
+        output.extend(format_function(f))
+    output.extend(format_trailer(prog.literals))
+    return output
 
-            for i, arg in enumerate(args):
-                name = arg["name"]
 
-                offset = 8 * i
-                lines.append(Mov("q", "%rbx", "%rdi"))
-                lines.append(Mov("q", f"${i + 1}", "%rsi"))
-                if arg["type"] == "int":
-                    lines.append(Call("q", "_bril_parse_int"))
-                else:
-                    lines.append(Call("q", "_bril_parse_bool"))
-                lines.append(Mov("q", "%rax", f"{offset}(%rsp)"))
+def fake_main_to_assembly(cfg: CFG):
+    lines = []
+    args = cfg.args
+    arg_regs = arg_registers([arg["type"] for arg in args])
+
+    # parsed arguments and a slot for %rbx
+    frame = aligned_frame(8 * (len(args) + 1) if args else 0, calls=True)
+    lines.append(AllocateStack(frame))
+
+    if args:
+        var_count = len(args)
+        lines.append(Mov("q", "%rbx", stack_slot(var_count * 8)))
+        lines.append(Mov("q", "%rsi", "%rbx"))
+
+        for i, arg in enumerate(args):
+            lines.append(Mov("q", "%rbx", "%rdi"))
+            lines.append(Mov("q", immediate(i + 1), "%rsi"))
+            if arg["type"] == "int":
+                lines.append(Call("q", "_bril_parse_int"))
+            elif arg["type"] == "float":
+                lines.append(Call("q", "_bril_parse_float"))
+            else:
+                lines.append(Call("q", "_bril_parse_bool"))
+            result = "%xmm0" if arg["type"] == "float" else "%rax"
+            lines.append(Mov("q", result, stack_slot(8 * i)))
 
-            for i, arg in enumerate(args):
-                off = i * 8
-                if i < len(arg_regs):
-                    lines.append(Mov("q", f"{off}(%rsp)", arg_regs[i]))
-                else:
-                    raise NotImplementedError(">6 args")
-            lines.append(Mov("q", f"{var_count * 8}(%rsp)", "%rbx"))
+        for i in range(var_count):
+            lines.append(Mov("q", stack_slot(8 * i), arg_regs[i]))
+        lines.append(Mov("q", stack_slot(var_count * 8), "%rbx"))
 
     lines.append(Call("q", "main_main"))
-    # lines.append(Jump("main_main"))
-
-    lines.extend([Mov("q", "%rbp", "%rsp"), Pop("q", "%rbp"), Ret()])
-
-    return Function(func["name"], lines)
+    # main_main may end in a tail call, so its %rax isn't always 0
+    lines.append(Binary(XOR, "%rax", "%rax"))
+    lines.extend([DeallocateStack(frame), Ret()])
+
+    return Function(cfg.name, lines)
+
+
+cmp_map = {
+    "lt": "l",
+    "gt": "g",
+    "le": "le",
+    "ge": "ge",
+    "eq": "e",
+}
+
+# condition code that holds after swapping the operands of a cmp
+swap_cc = {
+    "l": "g",
+    "g": "l",
+    "le": "ge",
+    "ge": "le",
+    "e": "e",
+}
+
+negate_cc = {
+    "l": "ge",
+    "ge": "l",
+    "g": "le",
+    "le": "g",
+    "e": "ne",
+    "ne": "e",
+    "a": "be",
+    "be": "a",
+    "ae": "b",
+    "b": "ae",
+}
+
+# float compares as (swap operands, condition code) for ucomisd; the
+# unordered result of a NaN sets CF and ZF, so only "above" conditions
+# come out false for it, and feq needs PF too
+fcmp_map = {
+    "fgt": (False, "a"),
+    "fge": (False, "ae"),
+    "flt": (True, "a"),
+    "fle": (True, "ae"),
+    "feq": (False, "e"),
+}
+
+float_ops = {"fadd": ADDSD, "fsub": SUBSD, "fmul": MULSD, "fdiv": DIVSD}
+
+int_arg_regs = ["%rdi", "%rsi", "%rdx", "%rcx", "%r8", "%r9"]
+float_arg_regs = [f"%xmm{i}" for i in range(8)]
+
+# type codes _bril_print_n in rt.c expects
+print_types = {"int": "i", "bool": "b", "float": "f"}
+
+
+def is_imm32(val: int) -> bool:
+    return -(2**31) <= val < 2**31
+
+
+def emit_const(lines, val: int, dest):
+    if is_imm32(val):
+        lines.append(Mov("q", immediate(val), dest))
+    elif is_reg(dest):
+        lines.append(Mov("absq", immediate(val), dest))
+    else:
+        lines.append(Mov("absq", immediate(val), "%rax"))
+        lines.append(Mov("q", "%rax", dest))
+
+
+def arg_registers(types) -> list[str]:
+    """
+    Where the SysV convention passes arguments of `types`: floats in order
+    through %xmm0-%xmm7, everything else through the integer registers.
+    """
+    ints, floats = iter(int_arg_regs), iter(float_arg_regs)
+    regs = [next(floats if typ == "float" else ints, None) for typ in types]
+    if None in regs:
+        raise NotImplementedError("arguments past the registers")
+    return regs
+
+
+def float_literal(literals: dict, val) -> str:
+    """The pool entry holding `val`, added if it isn't there yet."""
+    (bits,) = struct.unpack("<Q", struct.pack("<d", val))
+    if bits not in literals:
+        literals[bits] = f"bril.float{len(literals)}"
+    return f"_{literals[bits]}(%rip)"
+
+
+def emit_float_binary(lines, operator, a, b, dest, commutative):
+    # SSE arithmetic needs its destination in a register
+    if dest == b and dest != a and commutative:
+        a, b = b, a
+    work = dest if is_reg(dest) and dest != b else "%xmm15"
+    emit_move(lines, a, work)
+    lines.append(Binary(operator, b, work))
+    emit_move(lines, work, dest)
+
+
+def emit_float_select(lines, cc: str, a: str, b: str, dest: str):
+    """dest = a if the flags satisfy cc, else b, with cmov on the bits."""
+    emit_move(lines, b, "%rax")
+    emit_move(lines, a, "%rdx")
+    lines.append(Cmov(cc, "%rdx", "%rax"))
+    emit_move(lines, "%rax", dest)
+
+
+def emit_select(lines, cc: str, a: str, b: str, dest: str):
+    """dest = a if the flags satisfy cc, else b."""
+    work = dest if is_reg(dest) else "%rax"
+    if a == work:
+        a, b, cc = b, a, negate_cc[cc]
+    if b != work:
+        lines.append(Mov("q", b, work))
+    # cmov can't take an immediate; mov leaves the flags alone
+    if a.startswith("$"):
+        lines.append(Mov("q", a, "%rdx"))
+        a = "%rdx"
+    lines.append(Cmov(cc, a, work))
+    if work != dest:
+        lines.append(Mov("q", work, dest))
+
+
+def is_mem(operand: str) -> bool:
+    return operand.endswith(")")
+
+
+def emit_move(lines, src, dest):
+    if src == dest:
+        return
+    if is_mem(src) and is_mem(dest):
+        lines.append(Mov("q", src, "%rax"))
+        src = "%rax"
+    lines.append(Mov("q", src, dest))
+
+
+def emit_parallel_move(lines, moves):
+    """
+    Emit (src, dest) moves as if they all happened at once, breaking cycles
+    through %rax.
+    """
+    pending = [(src, dest) for src, dest in moves if src != dest]
+    while pending:
+        for i, (src, dest) in enumerate(pending):
+            if all(other != dest for other, _ in pending):
+                if is_mem(src) and is_mem(dest) and "%rax" in dict(pending):
+                    # %rax holds a value still to be moved
+                    lines.append(Push("q", src))
+                    lines.append(Pop("q", dest))
+                else:
+                    emit_move(lines, src, dest)
+                del pending[i]
+                break
+        else:
+            src = pending[0][0]
+            lines.append(Mov("q", src, "%rax"))
+            pending = [("%rax" if s == src else s, d) for s, d in pending]
 
 
-def func_to_assembly(func):
+def emit_binary(lines, operator, a, b, dest, commutative):
+    if is_reg(dest):
+        if dest == b and dest != a:
+            if commutative:
+                a, b = b, a
+            else:
+                emit_move(lines, a, "%rax")
+                lines.append(Binary(operator, b, "%rax"))
+                lines.append(Mov("q", "%rax", dest))
+                return
+        emit_move(lines, a, dest)
+        lines.append(Binary(operator, b, dest))
+    elif a == dest and not is_mem(b) and not isinstance(operator, Mul):
+        lines.append(Binary(operator, b, dest))
+    else:
+        emit_move(lines, a, "%rax")
+        lines.append(Binary(operator, b, "%rax"))
+        lines.append(Mov("q", "%rax", dest))
+
+
+def is_fusable(instr, following, uses) -> bool:
+    if instr["op"] != "ptradd" or following["op"] not in ("load", "store"):
+        return False
+    dest = instr["dest"]
+    return following["args"][0] == dest and uses[dest] == 1
+
+
+def print_array_size(n: int) -> int:
+    """Bytes for the values of an n-argument print and their type codes."""
+    return 8 * n + (n + 7) // 8 * 8
+
+
+def address(lines, base: str, index: str = None) -> str:
+    """
+    A memory operand for base + 8 * index, loading operands that aren't in
+    registers into %rax and %rdx.
+    """
+    if not is_reg(base):
+        lines.append(Mov("q", base, "%rax"))
+        base = "%rax"
+    if index is None:
+        return memory(base)
+    if index.startswith("$") and is_imm32(8 * int(index[1:])):
+        return memory(base, offset=8 * int(index[1:]))
+    if not is_reg(index):
+        lines.append(Mov("q", index, "%rdx"))
+        index = "%rdx"
+    return memory(base, index)
+
+
+def aligned_frame(size: int, calls: bool) -> int:
+    """
+    How far to move %rsp on entry for a frame of `size` bytes. %rsp is 8
+    past a 16-byte boundary on entry, and has to be on one at every call.
+    """
+    if calls and size % 16 == 0:
+        size += 8
+    return size
+
+
+def epilogue(alloc: Allocation, frame: int, ret=True) -> list[Instruction]:
+    lines = [Mov("q", slot, reg) for reg, slot in alloc.callee_saved.items()]
+    if frame > 0:
+        lines.append(DeallocateStack(frame))
+    if ret:
+        lines.append(Ret())
+    return lines
+
+
+def is_tail_call(instrs, k) -> bool:
+    """Is instrs[k] a call whose result (if any) is returned right after?"""
+    if instrs[k].get("op") != "call" or k + 1 >= len(instrs):
+        return False
+    following = instrs[k + 1]
+    if following.get("op") != "ret":
+        return False
+    returned = following.get("args", [])
+    if "dest" in instrs[k]:
+        return returned == [instrs[k]["dest"]]
+    return not returned
+
+
+def flag_readers(instrs, k: int, cond: str) -> int:
+    """
+    How many selects on `cond`, optionally followed by a br on it, come
+    right from instrs[k]; they can all use the flags of one compare.
+    """
+    count = 0
+    for instr in instrs[k:]:
+        if instr["op"] not in ("select", "br") or instr["args"][0] != cond:
+            break
+        count += 1
+        if instr["op"] == "br":
+            break
+    return count
+
+
+def func_to_assembly(
+    cfg: CFG, opts: Options = Options(), literals=None, pm: PassManager = PassManager()
+):
+    """
+    Lower `cfg`, adding its float constants to the `literals` pool. Register
+    allocation runs as a pass of `pm`.
+    """
+    if literals is None:
+        literals = {}
 
     lines = []
-    lines.append(Push("q", "%rbp"))
-    lines.append(Mov("q", "%rsp", "%rbp"))
-
-    var_types = {}
-    var_slots = {}
-    var_count = 0
-
-    arg_regs = ["%rdi", "%rsi", "%rdx", "%rcx", "%r8", "%r9"]
-    for i, arg in enumerate(func.get("args", [])):
-        if i < len(arg_regs):
-            var_slots[arg["name"]] = var_count
-            var_types[arg["name"]] = arg["type"]
-            assert var_count == i
-            var_count += 1
-            # lines.append(Mov("q", arg_regs[i], f"{off}(%rsp)"))
-        else:
-            raise NotImplementedError(">6")
 
-    for instr in func["instrs"]:
+    var_types = {arg["name"]: arg["type"] for arg in cfg.args}
+    arg_regs = arg_registers(var_types.values())
+
+    for instr in cfg.instructions():
         if "dest" not in instr:
             continue
 
         dest = instr["dest"]
-        if dest not in var_slots:
-            var_slots[dest] = var_count
-            var_count += 1
-
         if "type" in instr:
             typ = instr["type"]
             if dest in var_types and var_types[dest] != typ:
                 raise TypeError()
             var_types[dest] = typ
 
-    stack_bytes = var_count * 8
-    if stack_bytes > 0:
-        lines.append(AllocateStack(stack_bytes))
+    # variables that always hold the same small constant are used as
+    # immediates and never get a location; idivq can't take an immediate, so
+    # divisors need one unless the division is strength-reduced
+    floats = {var for var, typ in var_types.items() if typ == "float"}
+    consts = {
+        var: int(val) for var, val in constant_vars(cfg).items() if var not in floats
+    }
+    divisors = {i["args"][1] for i in cfg.instructions() if i.get("op") == "div"}
+    imm = {
+        var: immediate(val)
+        for var, val in consts.items()
+        if is_imm32(val)
+        and (var not in divisors or (opts.strength_reduction and val != 0))
+    }
+
+    if opts.regalloc:
+        alloc = pm.run(
+            "regalloc", register_allocation, cfg, opts.share_slots, imm, floats
+        )
+    else:
+        alloc = pm.run("regalloc", stack_allocation, cfg, opts.share_slots, imm)
+    loc = alloc.locations
 
-    for i, arg in enumerate(func.get("args", [])):
-        if i < len(arg_regs):
-            off = i * 8
-            lines.append(Mov("q", arg_regs[i], f"{off}(%rsp)"))
-        else:
-            raise NotImplementedError(">6")
+    def operand(var):
+        return imm[var] if var in imm else loc[var]
 
-    for instr in func["instrs"]:
-        if debug_mode:
-            print(instr)
-        if "label" in instr:
+    if opts.report_frames:
+        print(
+            f"{cfg.name}: frame {alloc.unshared_frame_size} -> {alloc.frame_size} bytes",
+            file=sys.stderr,
+        )
+
+    tails = set()
+    if opts.tail_calls:
+        tails = {
+            (block.index, k)
+            for block in cfg.blocks
+            for k in range(len(block.instrs))
+            if is_tail_call(block.instrs, k)
+        }
+
+    # slots are addressed off %rsp, so there's no frame pointer; only
+    # functions that call out need an aligned stack, so a leaf without spills
+    # or saved registers doesn't touch %rsp at all
+    calls = any(
+        instr["op"] in CALL_OPS and (block.index, k) not in tails
+        for block in cfg.blocks
+        for k, instr in enumerate(block.instrs)
+    )
+    # each print passes its values and their type codes in an array at the
+    # bottom of the frame, sized for the longest print
+    print_area = alloc.frame_size
+    printed = [
+        len(instr.get("args", []))
+        for instr in cfg.instructions()
+        if instr["op"] == "print"
+    ]
+    frame_size = print_area + max((print_array_size(n) for n in printed), default=0)
+    frame = aligned_frame(frame_size, calls)
+    if frame > 0:
+        lines.append(AllocateStack(frame))
+
+    for reg, slot in alloc.callee_saved.items():
+        lines.append(Mov("q", reg, slot))
+
+    # every ret goes through one copy of the epilogue, unless it's a bare ret
+    exit = None
+    if epilogue(alloc, frame) != [Ret()]:
+        exit = cfg.name + ".epilogue"
+
+    emit_parallel_move(
+        lines,
+        [(arg_regs[i], loc[arg["name"]]) for i, arg in enumerate(cfg.args)],
+    )
+    # self tail calls loop back to just after the prologue
+    entry = cfg.name + ".tail"
+    if any(cfg.blocks[b].instrs[k]["funcs"][0] == cfg.name for b, k in tails):
+        lines.append(Label(entry))
+
+    uses = Counter(a for instr in cfg.instructions() for a in instr.get("args", []))
+    # loads and stores right after the ptradd computing their only address
+    # use a scaled-index operand instead
+    fused = {
+        (block.index, k)
+        for block in cfg.blocks
+        for k in range(1, len(block.instrs))
+        if is_fusable(block.instrs[k - 1], block.instrs[k], uses)
+    }
+    runtime = {
+        "alloc": "_bril_arena_alloc" if opts.arena else "_bril_alloc",
+        "free": "_bril_arena_free" if opts.arena else "_bril_free",
+    }
+    # condition code left by a compare for the selects and br after it
+    flags = None
+
+    cfg.number()
+    for block in cfg.blocks:
+        if block.label is not None:
             if debug_mode:
-                print(instr["label"])
+                print(block.label)
 
-            lines.append(Label(func["name"] + instr["label"]))
-            continue
+            lines.append(Label(cfg.name + block.label))
+
+        for k, instr in enumerate(block.instrs):
+            if debug_mode:
+                print(instr)
+            pos = block.start + k + 1
 
-        if "op" in instr:
             op = instr["op"]
 
+            if (block.index, k - 1) in tails:
+                # the ret of a tail call
+                continue
+
+            if (block.index, k) in tails:
+                callee = instr["funcs"][0]
+                args = instr.get("args", [])
+                if callee == cfg.name:
+                    params = [loc[arg["name"]] for arg in cfg.args]
+                    emit_parallel_move(
+                        lines, [(operand(a), params[i]) for i, a in enumerate(args)]
+                    )
+                    lines.append(Jump(entry))
+                else:
+                    regs = arg_registers([var_types[a] for a in args])
+                    emit_parallel_move(
+                        lines, [(operand(a), regs[i]) for i, a in enumerate(args)]
+                    )
+                    lines.extend(epilogue(alloc, frame, ret=False))
+                    lines.append(TailCall(callee))
+                continue
+
             if op == "const":
-                dest = instr["dest"]
+                if instr["dest"] in imm:
+                    continue
+                dest = loc[instr["dest"]]
                 val = instr["value"]
-                off = var_slots[dest] * 8
 
                 if instr["type"] == "int":
-                    lines.append(Mov("q", f"${val}", f"{off}(%rsp)"))
+                    emit_const(lines, val, dest)
+                elif instr["type"] == "float":
+                    literal = float_literal(literals, float(val))
+                    work = dest if is_reg(dest) else "%xmm15"
+                    lines.append(Mov("sd", literal, work))
+                    emit_move(lines, work, dest)
                 else:
                     if val:
-                        lines.append(Mov("q", f"$1", f"{off}(%rsp)"))
+                        lines.append(Mov("q", f"$1", dest))
                     else:
-                        lines.append(Mov("q", f"$0", f"{off}(%rsp)"))
+                        lines.append(Mov("q", f"$0", dest))
 
             elif op in ("add", "sub", "mul", "and", "or"):
                 arg1, arg2 = instr["args"]
                 dest = instr["dest"]
-                off1 = var_slots[arg1] * 8
-                off2 = var_slots[arg2] * 8
-                lines.append(Mov("q", f"{off1}(%rsp)", "%rax"))
+
+                if op == "mul" and opts.strength_reduction:
+                    if arg1 in consts:
+                        arg1, arg2 = arg2, arg1
+                    if arg2 in consts:
+                        reduced = mul_by_constant(
+                            operand(arg1), consts[arg2], loc[dest]
+                        )
+                        if reduced is not None:
+                            lines.extend(reduced)
+                            continue
 
                 op_map = {
-                    "add": Add(),
-                    "sub": Sub(),
-                    "mul": Mul(),
-                    "and": And(),
-                    "or": Or(),
+                    "add": ADD,
+                    "sub": SUB,
+                    "mul": MUL,
+                    "and": AND,
+                    "or": OR,
                 }
-                lines.append(Binary(op_map[op], f"{off2}(%rsp)", "%rax"))
-
-                off_dest = var_slots[dest] * 8
-                lines.append(Mov("q", "%rax", f"{off_dest}(%rsp)"))
+                emit_binary(
+                    lines,
+                    op_map[op],
+                    operand(arg1),
+                    operand(arg2),
+                    loc[dest],
+                    op != "sub",
+                )
 
             elif op in ("lt", "gt", "le", "ge", "eq"):
                 arg1, arg2 = instr["args"]
-                dest = instr["dest"]
-                off1 = var_slots[arg1] * 8
-                off2 = var_slots[arg2] * 8
-                off_dest = var_slots[dest] * 8
-
-                cmp_map = {
-                    "lt": "l",
-                    "gt": "g",
-                    "le": "le",
-                    "ge": "ge",
-                    "eq": "e",
-                }
+                src1, src2 = operand(arg1), operand(arg2)
+                dest = loc[instr["dest"]]
+                cc = cmp_map[op]
+
+                if src1.startswith("$") and not src2.startswith("$"):
+                    src1, src2 = src2, src1
+                    cc = swap_cc[cc]
+                if not is_reg(src1) and not is_reg(src2):
+                    lines.append(Mov("q", src1, "%rax"))
+                    src1 = "%rax"
+                lines.append(Binary(CMP, src2, src1))
+
+                # selects and a br on the result right after can use the flags,
+                # and the bool only needs to exist if something else reads it
+                readers = flag_readers(block.instrs, k + 1, instr["dest"])
+                if readers:
+                    flags = cc
+                    if uses[instr["dest"]] == readers:
+                        continue
+
+                lines.append(Unary(set_cc(cc), "%al"))
+                if is_reg(dest):
+                    lines.append(Mov("zbq", "%al", dest))
+                else:
+                    lines.append(Mov("zbq", "%al", "%rax"))
+                    lines.append(Mov("q", "%rax", dest))
 
-                lines.append(Mov("q", f"{off1}(%rsp)", "%rax"))
-                lines.append(Binary(Cmp(), f"{off2}(%rsp)", "%rax"))
-                lines.append(Unary(Set(cmp_map[op]), "%al"))
-                lines.append(Mov("zbq", "%al", "%rax"))
-                lines.append(Mov("q", "%rax", f"{off_dest}(%rsp)"))
+            elif op in float_ops:
+                arg1, arg2 = instr["args"]
+                emit_float_binary(
+                    lines,
+                    float_ops[op],
+                    loc[arg1],
+                    loc[arg2],
+                    loc[instr["dest"]],
+                    op in ("fadd", "fmul"),
+                )
+
+            elif op in fcmp_map:
+                swap, cc = fcmp_map[op]
+                src1, src2 = (loc[a] for a in instr["args"])
+                if swap:
+                    src1, src2 = src2, src1
+                dest = loc[instr["dest"]]
+                if not is_reg(src1):
+                    lines.append(Mov("q", src1, "%xmm15"))
+                    src1 = "%xmm15"
+                lines.append(Binary(UCOMISD, src2, src1))
+
+                if op != "feq":
+                    readers = flag_readers(block.instrs, k + 1, instr["dest"])
+                    if readers:
+                        flags = cc
+                        if uses[instr["dest"]] == readers:
+                            continue
+                lines.append(Unary(set_cc(cc), "%al"))
+                if op == "feq":
+                    # equal and ordered
+                    lines.append(Unary(set_cc("np"), "%dl"))
+                    lines.append(Binary(AND, "%rdx", "%rax"))
+                if is_reg(dest):
+                    lines.append(Mov("zbq", "%al", dest))
+                else:
+                    lines.append(Mov("zbq", "%al", "%rax"))
+                    lines.append(Mov("q", "%rax", dest))
+
+            elif op == "select":
+                cond, arg1, arg2 = instr["args"]
+                dest = loc[instr["dest"]]
+                test = operand(cond)
+                if test.startswith("$"):
+                    emit_move(lines, operand(arg1 if test != "$0" else arg2), dest)
+                    continue
+                if flags is None:
+                    if is_reg(test):
+                        lines.append(Binary(TEST, test, test))
+                    else:
+                        lines.append(Binary(CMP, "$0", test))
+                    flags = "ne"
+                if instr["dest"] in floats:
+                    emit_float_select(lines, flags, operand(arg1), operand(arg2), dest)
+                else:
+                    emit_select(lines, flags, operand(arg1), operand(arg2), dest)
+                if not flag_readers(block.instrs, k + 1, cond):
+                    flags = None
 
             elif op == "div":
                 arg1, arg2 = instr["args"]
-                dest = instr["dest"]
-                off1 = var_slots[arg1] * 8
-                off2 = var_slots[arg2] * 8
-                off_dest = var_slots[dest] * 8
+                dest = loc[instr["dest"]]
 
-                lines.append(Mov("q", f"{off1}(%rsp)", "%rax"))
+                if opts.strength_reduction and consts.get(arg2, 0) != 0:
+                    if arg1 in imm:
+                        # only left over without sccp
+                        emit_const(lines, fold(op, [consts[arg1], consts[arg2]]), dest)
+                    else:
+                        lines.extend(div_by_constant(loc[arg1], consts[arg2]))
+                        emit_move(lines, "%rax", dest)
+                    continue
+
+                emit_move(lines, operand(arg1), "%rax")
                 lines.append(Cqo())
-                lines.append(Unary(Div(), f"{off2}(%rsp)"))
-                lines.append(Mov("q", "%rax", f"{off_dest}(%rsp)"))
+                lines.append(Unary(DIV, loc[arg2]))
+                emit_move(lines, "%rax", dest)
 
             elif op == "ret":
                 if "args" in instr and len(instr["args"]) > 0:
                     ret_var = instr["args"][0]
-                    off = var_slots[ret_var] * 8
-                    lines.append(Mov("q", f"{off}(%rsp)", "%rax"))
+                    result = "%xmm0" if ret_var in floats else "%rax"
+                    emit_move(lines, operand(ret_var), result)
+                else:
+                    lines.append(Binary(XOR, "%rax", "%rax"))
+                if exit is None:
+                    lines.append(Ret())
                 else:
-                    lines.append(Binary(Xor(), "%rax", "%rax"))
-                lines.extend([Mov("q", "%rbp", "%rsp"), Pop("q", "%rbp"), Ret()])
+                    lines.append(Jump(exit))
 
             elif op == "print":
-                args = [f"{8 * var_slots[x]}(%rsp)" for x in instr["args"]]
+                saved = alloc.crossing.get(pos, [])
+                for var in saved:
+                    lines.append(Mov("q", loc[var], alloc.homes[var]))
+
+                args = [
+                    alloc.homes[x] if x in saved else operand(x) for x in instr["args"]
+                ]
                 types = [var_types[x] for x in instr["args"]]
+                for typ in types:
+                    if not isinstance(typ, str) or typ not in print_types:
+                        raise NotImplementedError(f"printing {typ}")
 
                 n = len(args)
-
                 for i in range(n):
-                    lines.append(Mov("q", args[i], "%rdi"))
-                    if types[i] == "int":
-                        lines.append(Call("q", "_bril_print_int"))
-                    else:
-                        lines.append(Call("q", "_bril_print_bool"))
+                    emit_move(lines, args[i], stack_slot(print_area + 8 * i))
+                for i in range(n):
+                    code = immediate(ord(print_types[types[i]]))
+                    lines.append(Mov("b", code, stack_slot(print_area + 8 * n + i)))
+                lines.append(Lea(stack_slot(print_area), "%rdi"))
+                lines.append(Lea(stack_slot(print_area + 8 * n), "%rsi"))
+                lines.append(Mov("q", immediate(n), "%rdx"))
+                lines.append(Call("q", "_bril_print_n"))
 
-                    if i < n - 1:
-                        lines.append(Call("q", "_bril_print_sep"))
-                    else:
-                        lines.append(Call("q", "_bril_print_end"))
+                for var in saved:
+                    lines.append(Mov("q", alloc.homes[var], loc[var]))
 
             elif op == "id":
-                dest = instr["dest"]
-                src = instr["args"][0]
-                off_src = var_slots[src] * 8
-                off_dest = var_slots[dest] * 8
-
-                lines.append(Mov("q", f"{off_src}(%rsp)", "%rax"))
-                lines.append(Mov("q", "%rax", f"{off_dest}(%rsp)"))
+                emit_move(lines, operand(instr["args"][0]), loc[instr["dest"]])
 
             elif op == "br":
                 true_label, false_label = instr["labels"]
-                cond_var = instr["args"][0]
-                off = var_slots[cond_var] * 8
 
-                lines.append(Mov("q", f"{off}(%rsp)", "%rax"))
-                lines.append(Binary(Test(), "%rax", "%rax"))
-                lines.append(JumpCond("ne", func["name"] + true_label))
-                lines.append(Jump(func["name"] + false_label))
+                cond = operand(instr["args"][0])
+                if cond.startswith("$"):
+                    taken = true_label if cond != "$0" else false_label
+                    lines.append(Jump(cfg.name + taken))
+                    continue
+
+                if flags is None:
+                    if is_reg(cond):
+                        lines.append(Binary(TEST, cond, cond))
+                    else:
+                        lines.append(Binary(CMP, "$0", cond))
+                    flags = "ne"
+
+                next_block = (
+                    cfg.blocks[block.index + 1]
+                    if block.index + 1 < len(cfg.blocks)
+                    else None
+                )
+                fallthrough = next_block.label if next_block is not None else None
+                if fallthrough == true_label:
+                    lines.append(JumpCond(negate_cc[flags], cfg.name + false_label))
+                else:
+                    lines.append(JumpCond(flags, cfg.name + true_label))
+                    if fallthrough != false_label:
+                        lines.append(Jump(cfg.name + false_label))
+                flags = None
 
             elif op == "jmp":
                 target = instr["labels"][0]
-                lines.append(Jump(func["name"] + target))
+                lines.append(Jump(cfg.name + target))
 
             elif op == "call":
                 # print(instr)
@@ -538,27 +931,82 @@ def func_to_assembly(func):
                 args = instr.get("args", [])
                 dest = instr.get("dest", None)
 
-                for i, a in enumerate(args):
-                    off = var_slots[a] * 8
-                    if i < len(arg_regs):
-                        lines.append(Mov("q", f"{off}(%rsp)", arg_regs[i]))
-                    else:
-                        raise NotImplementedError(">6 args")
+                regs = arg_registers([var_types[a] for a in args])
+
+                saved = alloc.crossing.get(pos, [])
+                for var in saved:
+                    lines.append(Mov("q", loc[var], alloc.homes[var]))
 
+                emit_parallel_move(
+                    lines, [(operand(a), regs[i]) for i, a in enumerate(args)]
+                )
                 lines.append(Call("q", func_name))
 
+                for var in saved:
+                    lines.append(Mov("q", alloc.homes[var], loc[var]))
+
                 if dest is not None:
-                    off_d = var_slots[dest] * 8
-                    lines.append(Mov("q", "%rax", f"{off_d}(%rsp)"))
+                    result = "%xmm0" if dest in floats else "%rax"
+                    emit_move(lines, result, loc[dest])
+
+            elif op in ("alloc", "free"):
+                saved = alloc.crossing.get(pos, [])
+                for var in saved:
+                    lines.append(Mov("q", loc[var], alloc.homes[var]))
+
+                emit_move(lines, operand(instr["args"][0]), "%rdi")
+                if op == "alloc":
+                    # every element takes 8 bytes, bools included
+                    lines.append(Mov("q", "$8", "%rsi"))
+                lines.append(Call("q", runtime[op]))
+
+                for var in saved:
+                    lines.append(Mov("q", alloc.homes[var], loc[var]))
+                if op == "alloc":
+                    emit_move(lines, "%rax", loc[instr["dest"]])
+
+            elif op == "ptradd":
+                if (block.index, k + 1) in fused:
+                    continue
+                base, index = (operand(a) for a in instr["args"])
+                dest = loc[instr["dest"]]
+                work = dest if is_reg(dest) else "%rax"
+                lines.append(Lea(address(lines, base, index), work))
+                emit_move(lines, work, dest)
+
+            elif op in ("load", "store"):
+                index = None
+                if (block.index, k) in fused:
+                    base, index = (operand(a) for a in block.instrs[k - 1]["args"])
+                else:
+                    base = operand(instr["args"][0])
+                if op == "load":
+                    dest = loc[instr["dest"]]
+                    work = dest if is_reg(dest) else "%rax"
+                    lines.append(Mov("q", address(lines, base, index), work))
+                    emit_move(lines, work, dest)
+                    continue
+                value = operand(instr["args"][1])
+                target = address(lines, base, index)
+                if is_mem(value):
+                    # a value in memory needs a register of its own
+                    if "%rdx" in target:
+                        lines.append(Lea(target, "%rax"))
+                        target = "(%rax)"
+                    lines.append(Mov("q", value, "%rdx"))
+                    value = "%rdx"
+                lines.append(Mov("q", value, target))
 
             elif op == "not":
-                src = instr["args"][0]
-                dest = instr["dest"]
-                off_src = var_slots[src] * 8
-                off_dest = var_slots[dest] * 8
-                lines.append(Mov("q", f"{off_src}(%rsp)", "%rax"))
-                lines.append(Binary(Xor(), "$1", "%rax"))
-                lines.append(Mov("q", "%rax", f"{off_dest}(%rsp)"))
+                src = operand(instr["args"][0])
+                dest = loc[instr["dest"]]
+                if is_reg(dest):
+                    emit_move(lines, src, dest)
+                    lines.append(Binary(XOR, "$1", dest))
+                else:
+                    lines.append(Mov("q", src, "%rax"))
+                    lines.append(Binary(XOR, "$1", "%rax"))
+                    lines.append(Mov("q", "%rax", dest))
 
             elif op == "nop":
                 continue
@@ -566,42 +1014,337 @@ def func_to_assembly(func):
             else:
                 raise NotImplementedError(f"not supported op: {op}")
 
-    lines.extend(
-        [
-            Binary(Xor(), "%rax", "%rax"),
-            Mov("q", "%rbp", "%rsp"),
-            Pop("q", "%rbp"),
-            Ret(),
-        ]
-    )
+    lines.append(Binary(XOR, "%rax", "%rax"))
+    if exit is not None:
+        lines.append(Label(exit))
+    lines.extend(epilogue(alloc, frame))
 
-    return Function(func["name"], lines)
+    return Function(cfg.name, lines)
 
 
-def bril_to_assembly(prog):
-    functions = []
+def dump_ir(stage: str, cfg: CFG):
+    count = sum(len(b.instrs) for b in cfg.blocks)
+    print(f"; {cfg.name} after {stage}: {count} instructions", file=sys.stderr)
+    for line in cfg.text():
+        print(line, file=sys.stderr)
+
+
+class DumpIR(Hook):
+    """Print a function's Bril after every pass that rewrites it."""
+
+    def after(self, name: str, unit, result):
+        if isinstance(unit, CFG) and name not in ("regalloc", "lowering"):
+            dump_ir(name, unit)
+
+
+def compile_functions(prog, opts: Options, pm: PassManager, literals: dict):
+    """
+    Lower `prog`'s functions one at a time, yielding each once it's done, and
+    add their float constants to `literals`.
+    """
+    if opts.inline_threshold > 0:
+        prog, report = pm.run("inline", inline_program, prog, opts.inline_threshold)
+        pm.count(
+            "inline",
+            Counter(
+                {
+                    "call sites": sum(report.inlined.values()),
+                    "functions removed": len(report.removed),
+                }
+            ),
+        )
+        if opts.inline_report:
+            for line in report.lines():
+                print(f"inline: {line}", file=sys.stderr)
+
+    hits = Counter()
     for func in prog["functions"]:
-        name = func["name"]
-        if name == "main":
-            functions.append(fake_main_to_assembly(func))
-            func["name"] = "main_main"
-            functions.append(func_to_assembly(func))
-        else:
-            functions.append(func_to_assembly(func))
-        # functions.append(func_to_assembly(func))
+        cfg = CFG.from_function(func)
+        if opts.dump_ir:
+            dump_ir("input", cfg)
+        if opts.sccp:
+            pm.run("sccp", sccp, cfg)
+        if opts.ssa:
+            stats = optimize(
+                cfg,
+                pm,
+                loop_opts=opts.loop_opts,
+                unroll_factor=opts.unroll_factor,
+                unroll_budget=opts.unroll_budget,
+                if_conversion=opts.if_conversion,
+            )
+            if opts.dump_ir:
+                print(
+                    f"; {cfg.name}: gvn removed {stats['gvn']}, if-converted "
+                    f"{stats['if-converted']} branches, hoisted "
+                    f"{stats['hoisted']}, reduced {stats['ivs']} multiplies, unrolled "
+                    f"{stats['unrolled']} loops, "
+                    f"dce removed {stats['dce']}, {stats['copies']} copies left",
+                    file=sys.stderr,
+                )
+        if opts.layout:
+            pm.run("layout", layout, cfg)
+        lowered = []
+        if cfg.name == "main":
+            lowered.append(pm.run("lowering", fake_main_to_assembly, cfg))
+            cfg.name = "main_main"
+        lowered.append(pm.run("lowering", func_to_assembly, cfg, opts, literals, pm))
+        for f in lowered:
+            if opts.peephole:
+                f = pm.run("peephole", peephole, f, hits)
+            yield f
+
+    if opts.peephole:
+        pm.count("peephole", hits)
+        if opts.peephole_stats:
+            for name, count in sorted(hits.items()):
+                print(f"peephole {name}: {count}", file=sys.stderr)
+
+
+def bril_to_assembly(prog, opts: Options = Options(), pm: PassManager = PassManager()):
+    literals = {}
+    functions = list(compile_functions(prog, opts, pm, literals))
+    return Program(functions, literals)
+
+
+def write_program(
+    prog, out, opts: Options = Options(), pm: PassManager = PassManager()
+):
+    """
+    Compile `prog` and write its assembly to `out` a function at a time, so
+    only one function's instructions are held at once.
+    """
+    literals = {}
+    out.write("\n".join(format_header()) + "\n")
+    for f in compile_functions(prog, opts, pm, literals):
+        if debug_mode:
+            print(f)
+        out.write("\n".join(pm.run("format", format_function, f)) + "\n")
+    out.write("\n".join(format_trailer(literals)) + "\n")
 
-    return Program(functions)
 
+def argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Compile Bril to x86_64.")
+    parser.add_argument(
+        "input",
+        nargs="?",
+        help="Bril program as text or JSON; read from stdin if omitted",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="FILE",
+        help="write the assembly to FILE instead of stdout",
+    )
+    parser.add_argument(
+        "--serve",
+        nargs="?",
+        const=default_socket(),
+        metavar="SOCKET",
+        help="stay resident and compile the requests sent to a Unix socket "
+        "(client.py sends them), or to stdin with '-'",
+    )
+    parser.add_argument(
+        "--no-regalloc",
+        dest="regalloc",
+        action="store_false",
+        help="keep every variable in its own stack slot",
+    )
+    parser.add_argument(
+        "--inline-threshold",
+        type=int,
+        default=Options.inline_threshold,
+        metavar="N",
+        help="inline non-recursive functions of at most N instructions (0 disables)",
+    )
+    parser.add_argument(
+        "--inline-report",
+        action="store_true",
+        help="print the inlined call sites and resulting code growth",
+    )
+    parser.add_argument(
+        "--no-sccp",
+        dest="sccp",
+        action="store_false",
+        help="skip constant propagation and folding",
+    )
+    parser.add_argument(
+        "--no-ssa",
+        dest="ssa",
+        action="store_false",
+        help="skip SSA construction, value numbering and dead code elimination",
+    )
+    parser.add_argument(
+        "--no-if-conversion",
+        dest="if_conversion",
+        action="store_false",
+        help="keep small branch diamonds as branches instead of using cmov",
+    )
+    parser.add_argument(
+        "--no-loop-opts",
+        dest="loop_opts",
+        action="store_false",
+        help="skip loop-invariant code motion and induction variable strength reduction",
+    )
+    parser.add_argument(
+        "--unroll-factor",
+        type=int,
+        default=Options.unroll_factor,
+        metavar="N",
+        help="run N copies of a counted loop's body per test (1 disables partial unrolling)",
+    )
+    parser.add_argument(
+        "--unroll-budget",
+        type=int,
+        default=Options.unroll_budget,
+        metavar="N",
+        help="let unrolling add at most N instructions per function (0 disables)",
+    )
+    parser.add_argument(
+        "--dump-ir",
+        action="store_true",
+        help="print each function's Bril after every stage to stderr",
+    )
+    parser.add_argument(
+        "--no-layout",
+        dest="layout",
+        action="store_false",
+        help="keep blocks in source order and don't thread jumps",
+    )
+    parser.add_argument(
+        "--no-tail-calls",
+        dest="tail_calls",
+        action="store_false",
+        help="keep calls in tail position as calls, so every frame shows up in a backtrace",
+    )
+    parser.add_argument(
+        "--no-strength-reduction",
+        dest="strength_reduction",
+        action="store_false",
+        help="use imulq and idivq for multiplication and division by constants",
+    )
+    parser.add_argument(
+        "--no-arena",
+        dest="arena",
+        action="store_false",
+        help="call malloc and free for every alloc and free",
+    )
+    parser.add_argument(
+        "--no-slot-sharing",
+        dest="share_slots",
+        action="store_false",
+        help="give every stack value its own slot, even if lifetimes are disjoint",
+    )
+    parser.add_argument(
+        "--report-frames",
+        action="store_true",
+        help="print each function's frame size before and after slot sharing",
+    )
+    parser.add_argument(
+        "--no-peephole",
+        dest="peephole",
+        action="store_false",
+        help="emit instructions exactly as lowered",
+    )
+    parser.add_argument(
+        "--peephole-stats",
+        action="store_true",
+        help="print how often each peephole rule fired",
+    )
+    parser.add_argument(
+        "--time-passes",
+        action="store_true",
+        help="print each pass's time, peak memory, instruction counts and "
+        "counters to stderr",
+    )
+    parser.add_argument(
+        "--stats-json",
+        metavar="FILE",
+        help="write the --time-passes numbers, and each function's, to FILE as JSON",
+    )
+    return parser
+
+
+def main(argv=None, read_stdin=None):
+    """
+    Do what the command line `argv` asks. A program to be read from stdin
+    comes from `read_stdin` instead when given, as it is in the server.
+    """
+    args = argument_parser().parse_args(argv)
+    if args.serve is not None:
+        if read_stdin is not None:
+            raise SystemExit("--serve: already serving")
+        if args.serve == "-":
+            serve_stream(main, sys.stdin, sys.stdout)
+        else:
+            serve_socket(main, args.serve)
+        return
+
+    opts = Options(
+        regalloc=args.regalloc,
+        inline_threshold=args.inline_threshold,
+        inline_report=args.inline_report,
+        sccp=args.sccp,
+        ssa=args.ssa,
+        if_conversion=args.if_conversion,
+        loop_opts=args.loop_opts,
+        unroll_factor=args.unroll_factor,
+        unroll_budget=args.unroll_budget,
+        dump_ir=args.dump_ir,
+        layout=args.layout,
+        tail_calls=args.tail_calls,
+        strength_reduction=args.strength_reduction,
+        arena=args.arena,
+        share_slots=args.share_slots,
+        report_frames=args.report_frames,
+        peephole=args.peephole,
+        peephole_stats=args.peephole_stats,
+    )
+
+    hooks = []
+    stats = None
+    if args.time_passes or args.stats_json:
+        stats = PassStats()
+        hooks.append(stats)
+    if args.dump_ir:
+        hooks.append(DumpIR())
+    pm = PassManager(hooks)
+
+    if args.input is None:
+        source = (read_stdin or sys.stdin.read)()
+    else:
+        with open(args.input) as f:
+            source = f.read()
+    try:
+        # JSON is an object; text starts with a function or a comment
+        if source.lstrip().startswith("{"):
+            prog = pm.run("parse", json.loads, source)
+        else:
+            prog = pm.run("parse", parse_program, source)
 
-if __name__ == "__main__":
-    prog = json.load(sys.stdin)
+        if args.output is None:
+            write_program(prog, sys.stdout, opts, pm)
+        else:
+            # written beside the target and renamed, so a failed compile
+            # doesn't leave half a file behind
+            partial = args.output + ".partial"
+            try:
+                with open(partial, "w", buffering=OUTPUT_BUFFER) as out:
+                    write_program(prog, out, opts, pm)
+                os.replace(partial, args.output)
+            finally:
+                if os.path.exists(partial):
+                    os.unlink(partial)
+    finally:
+        if stats is not None:
+            stats.finish()
+
+    if args.time_passes:
+        for line in stats.report():
+            print(line, file=sys.stderr)
+    if args.stats_json:
+        stats.write_json(args.stats_json)
 
-    # print(Ret().format())
-    # print(format_instruction(Ret()))
-    # print(format_instruction(Mov("hi", "bye")))
-    prog = bril_to_assembly(prog)
-    if debug_mode:
-        print(prog)
 
-    formatted = format_program(prog)
-    [print(i) for i in formatted]
+if __name__ == "__main__":
+    main()
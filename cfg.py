@@ -0,0 +1,313 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+TERMINATORS = ("jmp", "br", "ret")
+
+
+@dataclass
+class BasicBlock:
+    index: int
+    # Bril label that starts the block, if any
+    label: Optional[str]
+    # Bril instructions of the block, labels excluded
+    instrs: list[dict]
+    succs: list[int] = field(default_factory=list)
+    preds: list[int] = field(default_factory=list)
+    # linear position of the block entry; instruction k sits at start + k + 1
+    start: int = 0
+
+    def terminator(self) -> Optional[dict]:
+        if self.instrs and self.instrs[-1].get("op") in TERMINATORS:
+            return self.instrs[-1]
+        return None
+
+
+@dataclass
+class Loop:
+    header: int
+    blocks: set[int]
+    # back-edge sources
+    latches: list[int]
+    parent: Optional["Loop"] = None
+    children: list["Loop"] = field(default_factory=list)
+    depth: int = 1
+
+
+@dataclass
+class CFG:
+    name: str
+    args: list[dict]
+    type: Optional[object]
+    blocks: list[BasicBlock]
+
+    @staticmethod
+    def from_function(func) -> "CFG":
+        blocks = []
+        current = None
+        for instr in func["instrs"]:
+            if "label" in instr:
+                current = BasicBlock(len(blocks), instr["label"], [])
+                blocks.append(current)
+                continue
+            if current is None:
+                current = BasicBlock(len(blocks), None, [])
+                blocks.append(current)
+            current.instrs.append(instr)
+            if instr.get("op") in TERMINATORS:
+                current = None
+
+        if not blocks:
+            blocks.append(BasicBlock(0, None, []))
+
+        cfg = CFG(func["name"], func.get("args", []), func.get("type"), blocks)
+        cfg.link()
+        return cfg
+
+    def link(self):
+        """(Re)compute successor and predecessor edges from the terminators."""
+        by_label = {b.label: b.index for b in self.blocks if b.label is not None}
+        for b in self.blocks:
+            b.succs = []
+            b.preds = []
+        for b in self.blocks:
+            term = b.terminator()
+            if term is None:
+                if b.index + 1 < len(self.blocks):
+                    b.succs.append(b.index + 1)
+            elif term["op"] in ("jmp", "br"):
+                for label in term["labels"]:
+                    if by_label[label] not in b.succs:
+                        b.succs.append(by_label[label])
+            for s in b.succs:
+                self.blocks[s].preds.append(b.index)
+
+    def number(self):
+        """Assign linear positions; position 0 is reserved for the arguments."""
+        pos = 1
+        for b in self.blocks:
+            b.start = pos
+            pos += len(b.instrs) + 1
+        return pos
+
+    def instructions(self):
+        for b in self.blocks:
+            yield from b.instrs
+
+    def to_function(self) -> dict:
+        instrs = []
+        for b in self.blocks:
+            if b.label is not None:
+                instrs.append({"label": b.label})
+            instrs.extend(b.instrs)
+        func = {"name": self.name, "instrs": instrs}
+        if self.args:
+            func["args"] = self.args
+        if self.type is not None:
+            func["type"] = self.type
+        return func
+
+    def text(self) -> list[str]:
+        """The function in Bril's text form."""
+        args = ", ".join(f"{a['name']}: {format_type(a['type'])}" for a in self.args)
+        header = f"@{self.name}({args})" if self.args else f"@{self.name}"
+        if self.type is not None:
+            header += f": {format_type(self.type)}"
+        lines = [header + " {"]
+        for b in self.blocks:
+            if b.label is not None:
+                lines.append(f".{b.label}:")
+            lines.extend(f"  {format_instr(instr)}" for instr in b.instrs)
+        lines.append("}")
+        return lines
+
+    def reverse_postorder(self) -> list[int]:
+        seen = [False] * len(self.blocks)
+        order = []
+        seen[0] = True
+        stack = [(0, iter(self.blocks[0].succs))]
+        while stack:
+            b, it = stack[-1]
+            for s in it:
+                if not seen[s]:
+                    seen[s] = True
+                    stack.append((s, iter(self.blocks[s].succs)))
+                    break
+            else:
+                stack.pop()
+                order.append(b)
+        order.reverse()
+        return order
+
+    def dominators(self) -> list[Optional[int]]:
+        """
+        Immediate dominator of every block (Cooper, Harvey & Kennedy).
+        The entry is its own idom; unreachable blocks get None.
+        """
+        rpo = self.reverse_postorder()
+        rank = {b: i for i, b in enumerate(rpo)}
+        idom: list[Optional[int]] = [None] * len(self.blocks)
+        idom[0] = 0
+
+        def intersect(a, b):
+            while a != b:
+                while rank[a] > rank[b]:
+                    a = idom[a]
+                while rank[b] > rank[a]:
+                    b = idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for b in rpo[1:]:
+                new = None
+                for p in self.blocks[b].preds:
+                    if idom[p] is None:
+                        continue
+                    new = p if new is None else intersect(p, new)
+                if new != idom[b]:
+                    idom[b] = new
+                    changed = True
+        return idom
+
+    def dominator_tree(self, idom=None) -> list[list[int]]:
+        if idom is None:
+            idom = self.dominators()
+        children = [[] for _ in self.blocks]
+        for b, d in enumerate(idom):
+            if d is not None and b != 0:
+                children[d].append(b)
+        return children
+
+    def loops(self, idom=None) -> list[Loop]:
+        """
+        Natural loops, outermost first. Back edges sharing a header form one
+        loop; nesting follows block containment.
+        """
+        if idom is None:
+            idom = self.dominators()
+
+        # pre/post numbering of the dominator tree answers dominance in O(1)
+        pre = [0] * len(self.blocks)
+        post = [0] * len(self.blocks)
+        children = self.dominator_tree(idom)
+        counter = 0
+        stack = [(0, iter(children[0]))]
+        pre[0] = counter
+        while stack:
+            b, it = stack[-1]
+            child = next(it, None)
+            counter += 1
+            if child is None:
+                post[b] = counter
+                stack.pop()
+            else:
+                pre[child] = counter
+                stack.append((child, iter(children[child])))
+
+        by_header = {}
+        for b in self.blocks:
+            if idom[b.index] is None:
+                continue
+            for s in b.succs:
+                if pre[s] <= pre[b.index] and post[b.index] <= post[s]:
+                    by_header.setdefault(s, []).append(b.index)
+
+        loops = []
+        for header, latches in by_header.items():
+            body = {header}
+            work = [l for l in latches if l != header]
+            body.update(work)
+            while work:
+                n = work.pop()
+                for p in self.blocks[n].preds:
+                    if p not in body and idom[p] is not None:
+                        body.add(p)
+                        work.append(p)
+            loops.append(Loop(header, body, latches))
+
+        # natural loops with distinct headers are nested or disjoint, so the
+        # innermost loop seen so far that holds a header is its parent
+        loops.sort(key=lambda l: len(l.blocks), reverse=True)
+        innermost: dict[int, Loop] = {}
+        for loop in loops:
+            parent = innermost.get(loop.header)
+            if parent is not None:
+                loop.parent = parent
+                loop.depth = parent.depth + 1
+                parent.children.append(loop)
+            for b in loop.blocks:
+                innermost[b] = loop
+        return loops
+
+    def loop_depths(self, loops=None) -> list[int]:
+        if loops is None:
+            loops = self.loops()
+        depth = [0] * len(self.blocks)
+        for loop in loops:
+            for b in loop.blocks:
+                depth[b] = max(depth[b], loop.depth)
+        return depth
+
+
+def format_instr(instr: dict) -> str:
+    """An instruction in Bril's text form."""
+    if "label" in instr:
+        return f".{instr['label']}:"
+    op = instr["op"]
+    if op == "const":
+        value = instr["value"]
+        if isinstance(value, bool):
+            value = str(value).lower()
+        rhs = f"const {value}"
+    else:
+        parts = [op]
+        parts += [f"@{f}" for f in instr.get("funcs", [])]
+        parts += instr.get("args", [])
+        parts += [f".{l}" for l in instr.get("labels", [])]
+        rhs = " ".join(parts)
+    if "dest" in instr:
+        return f"{instr['dest']}: {format_type(instr['type'])} = {rhs};"
+    return f"{rhs};"
+
+
+def format_type(typ) -> str:
+    if isinstance(typ, dict):
+        ((name, inner),) = typ.items()
+        return f"{name}<{format_type(inner)}>"
+    return typ
+
+
+def liveness(cfg: CFG):
+    """Return (live_in, live_out) variable sets per block."""
+    uses, defs = [], []
+    for b in cfg.blocks:
+        use, kill = set(), set()
+        for instr in b.instrs:
+            for a in instr.get("args", []):
+                if a not in kill:
+                    use.add(a)
+            if "dest" in instr:
+                kill.add(instr["dest"])
+        uses.append(use)
+        defs.append(kill)
+
+    live_in = [set() for _ in cfg.blocks]
+    live_out = [set() for _ in cfg.blocks]
+    work = list(range(len(cfg.blocks)))
+    queued = [True] * len(cfg.blocks)
+    while work:
+        b = work.pop()
+        queued[b] = False
+        out = set()
+        for s in cfg.blocks[b].succs:
+            out |= live_in[s]
+        live_out[b] = out
+        new_in = uses[b] | (out - defs[b])
+        if new_in != live_in[b]:
+            live_in[b] = new_in
+            for p in cfg.blocks[b].preds:
+                if not queued[p]:
+                    queued[p] = True
+                    work.append(p)
+    return live_in, live_out
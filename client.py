@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Drop-in replacement for `python3 bril2x86.py`: hands the command line to
+the compiler started with `bril2x86.py --serve`, or runs the compiler
+itself if no server is listening. Only the standard library is imported,
+so starting up stays cheap.
+"""
+
+import json
+import os
+import socket
+import sys
+
+from server import default_socket
+
+
+def request(conn: socket.socket, argv: list[str]) -> dict:
+    with conn.makefile("r") as inp, conn.makefile("w") as out:
+        out.write(json.dumps({"args": argv, "cwd": os.getcwd()}) + "\n")
+        out.flush()
+        reply = json.loads(inp.readline())
+        if reply.get("stdin"):
+            out.write(json.dumps({"source": sys.stdin.read()}) + "\n")
+            out.flush()
+            reply = json.loads(inp.readline())
+    return reply
+
+
+def main():
+    argv = sys.argv[1:]
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(default_socket())
+    except OSError:
+        compiler = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "bril2x86.py"
+        )
+        os.execv(sys.executable, [sys.executable, compiler, *argv])
+    with conn:
+        reply = request(conn, argv)
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    sys.exit(reply["status"])
+
+
+if __name__ == "__main__":
+    main()
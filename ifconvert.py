@@ -0,0 +1,142 @@
+from cfg import CFG, BasicBlock
+from layout import explicit_jumps, place_blocks
+from loops import UNDEFINED, phis
+
+# operations that are cheap and can't trap, so both arms may run them
+SPECULABLE = {"const", "id", "add", "sub", "mul", "eq", "lt", "gt", "le", "ge"}
+SPECULABLE |= {"not", "and", "or", "select"}
+# rough cost of running an instruction whether or not its arm was taken
+COST = {"mul": 3}
+# most the arms and the selects may cost together; beyond this a branch,
+# even a mispredicted one, is cheaper
+MAX_COST = 6
+
+COMPARISONS = {"eq", "lt", "gt", "le", "ge"}
+
+
+def arm_cost(block: BasicBlock):
+    """What running `block` unconditionally costs, or None if it can't."""
+    cost = 0
+    for instr in block.instrs:
+        op = instr["op"]
+        if op == "jmp":
+            continue
+        if op not in SPECULABLE:
+            return None
+        cost += COST.get(op, 1)
+    return cost
+
+
+def shape(cfg: CFG, block: BasicBlock):
+    """
+    (true arm, false arm, join) if `block` branches into a diamond or a
+    triangle; the missing arm of a triangle is None.
+    """
+    term = block.terminator()
+    if term is None or term["op"] != "br" or len(block.succs) != 2:
+        return None
+    t, f = (cfg.blocks[s] for s in block.succs)
+
+    def arm(b):
+        return b.preds == [block.index] and len(b.succs) == 1
+
+    if arm(t) and arm(f) and t.succs == f.succs:
+        join = cfg.blocks[t.succs[0]]
+        if sorted(join.preds) == sorted([t.index, f.index]):
+            return t, f, join
+    if (
+        arm(t)
+        and t.succs == [f.index]
+        and sorted(f.preds) == sorted([block.index, t.index])
+    ):
+        return t, None, f
+    if (
+        arm(f)
+        and f.succs == [t.index]
+        and sorted(t.preds) == sorted([block.index, f.index])
+    ):
+        return None, f, t
+    return None
+
+
+def convert(cfg: CFG, block: BasicBlock, t, f, join) -> bool:
+    """
+    Run both arms in `block`, turn the join's phis into selects and merge the
+    join into `block`. Returns False if the cost model says no.
+    """
+    arms = [b for b in (t, f) if b is not None]
+    costs = [arm_cost(b) for b in arms]
+    selects = list(phis(join))
+    if None in costs or sum(costs) + len(selects) > MAX_COST:
+        return False
+
+    cond = block.terminator()["args"][0]
+    true_label = (t or block).label
+    false_label = (f or block).label
+    copies, chosen = [], []
+    for phi in selects:
+        values = dict(zip(phi["labels"], phi["args"]))
+        a, b = values[true_label], values[false_label]
+        instr = {"dest": phi["dest"], "op": "id", "type": phi["type"]}
+        if a == b or b == UNDEFINED:
+            instr["args"] = [a]
+        elif a == UNDEFINED:
+            instr["args"] = [b]
+        else:
+            instr.update(op="select", args=[cond, a, b])
+        if instr["args"] == [UNDEFINED]:
+            return False
+        (chosen if instr["op"] == "select" else copies).append(instr)
+
+    body = block.instrs[:-1]
+    speculated = [i for b in arms for i in b.instrs if i["op"] != "jmp"]
+    # keep a compare right in front of its selects, so they can use its flags
+    test = [i for i in body if i.get("dest") == cond and i["op"] in COMPARISONS]
+    if test:
+        after = body[body.index(test[0]) + 1 :] + speculated + copies
+        if any(cond in i.get("args", []) for i in after):
+            test = []
+        else:
+            body.remove(test[0])
+    rest = join.instrs[len(selects) :]
+    block.instrs = body + speculated + copies + test + chosen + rest
+
+    for s in join.succs:
+        for phi in phis(cfg.blocks[s]):
+            phi["labels"] = [
+                block.label if l == join.label else l for l in phi["labels"]
+            ]
+    return True
+
+
+def if_convert(cfg: CFG) -> int:
+    """
+    Replace small branch diamonds and triangles whose arms only compute
+    values by straight-line code ending in selects, which lowering turns
+    into cmov. Expects SSA. Returns the number of branches removed.
+    """
+    converted = 0
+    jumps_made = False
+    while True:
+        # edges are stale around converted blocks until the next relink
+        gone, changed = set(), set()
+        for block in cfg.blocks:
+            if block.index in changed:
+                continue
+            found = shape(cfg, block)
+            if found is None:
+                continue
+            t, f, join = found
+            touched = {b.index for b in found if b is not None}
+            if touched & changed:
+                continue
+            if not jumps_made:
+                explicit_jumps(cfg)
+                jumps_made = True
+            if convert(cfg, block, t, f, join):
+                gone |= touched
+                changed |= touched | {block.index}
+                converted += 1
+        if not gone:
+            return converted
+        place_blocks(cfg, [b.index for b in cfg.blocks if b.index not in gone])
@@ -0,0 +1,210 @@
+from collections import Counter
+from dataclasses import dataclass, field
+
+
+@dataclass
+class InlineReport:
+    # (caller, callee) -> number of call sites inlined
+    inlined: Counter = field(default_factory=Counter)
+    # functions dropped because every call to them was inlined
+    removed: list[str] = field(default_factory=list)
+    size_before: int = 0
+    size_after: int = 0
+
+    def lines(self) -> list[str]:
+        out = [
+            f"inlined {callee} into {caller} ({count} call sites)"
+            for (caller, callee), count in sorted(self.inlined.items())
+        ]
+        out.extend(f"removed {name}" for name in self.removed)
+        growth = self.size_after - self.size_before
+        out.append(
+            f"instructions: {self.size_before} -> {self.size_after} ({growth:+d})"
+        )
+        return out
+
+
+def size(func) -> int:
+    return sum(1 for instr in func["instrs"] if "op" in instr)
+
+
+def call_graph(funcs) -> dict[str, list[str]]:
+    return {
+        name: [
+            instr["funcs"][0]
+            for instr in func["instrs"]
+            if instr.get("op") == "call" and instr["funcs"][0] in funcs
+        ]
+        for name, func in funcs.items()
+    }
+
+
+def strongly_connected(graph):
+    """
+    Tarjan's algorithm. Components come out callees first, i.e. in reverse
+    topological order of the condensed call graph.
+    """
+    index, low = {}, {}
+    stack, on_stack = [], set()
+    components = []
+    counter = 0
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            node, it = work[-1]
+            for succ in it:
+                if succ not in index:
+                    index[succ] = low[succ] = counter
+                    counter += 1
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(graph[succ])))
+                    break
+                if succ in on_stack:
+                    low[node] = min(low[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def names(func) -> set[str]:
+    """Variables and labels of `func`, labels as mangled for assembly."""
+    out = {arg["name"] for arg in func.get("args", [])}
+    for instr in func["instrs"]:
+        if "label" in instr:
+            out.add(instr["label"].replace(".", "_"))
+        if "dest" in instr:
+            out.add(instr["dest"])
+        out.update(instr.get("args", []))
+    return out
+
+
+def fresh_prefix(base: str, taken: set[str], counter: Counter) -> str:
+    """
+    A prefix `base.n.` that no name in `taken` starts with, before or after
+    mangling dots in labels. The prefix without its final dot is free too.
+    """
+    while True:
+        stem = f"{base}.{counter[base]}"
+        counter[base] += 1
+        mangled = stem.replace(".", "_")
+        if not any(n.startswith(stem) or n.startswith(mangled) for n in taken):
+            return stem + "."
+
+
+def expand(call, callee, prefix: str) -> list[dict]:
+    """The body of `callee` renamed under `prefix`, in place of `call`."""
+    done = prefix[:-1]
+    out = [
+        {
+            "dest": prefix + param["name"],
+            "op": "id",
+            "type": param["type"],
+            "args": [arg],
+        }
+        for param, arg in zip(callee.get("args", []), call.get("args", []))
+    ]
+
+    for instr in callee["instrs"]:
+        if "label" in instr:
+            out.append({"label": prefix + instr["label"]})
+            continue
+        instr = dict(instr)
+        if "args" in instr:
+            instr["args"] = [prefix + a for a in instr["args"]]
+        if "dest" in instr:
+            instr["dest"] = prefix + instr["dest"]
+        if "labels" in instr:
+            instr["labels"] = [prefix + label for label in instr["labels"]]
+
+        if instr.get("op") != "ret":
+            out.append(instr)
+            continue
+        if "dest" in call and instr.get("args"):
+            out.append(
+                {
+                    "dest": call["dest"],
+                    "op": "id",
+                    "type": call["type"],
+                    "args": instr["args"],
+                }
+            )
+        out.append({"op": "jmp", "labels": [done]})
+
+    out.append({"label": done})
+    return out
+
+
+def inline_program(prog, threshold: int) -> tuple[dict, InlineReport]:
+    """
+    Inline calls to non-recursive functions of at most `threshold`
+    instructions. Callees are processed first, so they are already expanded
+    by the time they get inlined themselves. Functions whose every call was
+    inlined are dropped.
+    """
+    funcs = {func["name"]: func for func in prog["functions"]}
+    report = InlineReport(size_before=sum(size(f) for f in funcs.values()))
+    graph = call_graph(funcs)
+    components = strongly_connected(graph)
+
+    recursive = set()
+    for component in components:
+        if len(component) > 1 or component[0] in graph[component[0]]:
+            recursive.update(component)
+
+    def inlinable(instr):
+        if instr.get("op") != "call":
+            return False
+        callee = instr["funcs"][0]
+        return (
+            callee in funcs
+            and callee not in recursive
+            and size(funcs[callee]) <= threshold
+        )
+
+    for component in components:
+        for name in component:
+            func = funcs[name]
+            if not any(inlinable(instr) for instr in func["instrs"]):
+                continue
+            taken = names(func)
+            counter = Counter()
+            instrs = []
+            for instr in func["instrs"]:
+                if not inlinable(instr):
+                    instrs.append(instr)
+                    continue
+                callee = instr["funcs"][0]
+                prefix = fresh_prefix(callee, taken, counter)
+                instrs.extend(expand(instr, funcs[callee], prefix))
+                report.inlined[(name, callee)] += 1
+            funcs[name] = dict(func, instrs=instrs)
+
+    called = {callee for callees in graph.values() for callee in callees}
+    still_called = {c for callees in call_graph(funcs).values() for c in callees}
+    for name in called - still_called - {"main"}:
+        del funcs[name]
+        report.removed.append(name)
+    report.removed.sort()
+
+    report.size_after = sum(size(f) for f in funcs.values())
+    functions = [funcs[f["name"]] for f in prog["functions"] if f["name"] in funcs]
+    return dict(prog, functions=functions), report
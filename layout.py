@@ -0,0 +1,134 @@
+from collections import Counter
+
+from cfg import CFG
+
+
+def explicit_jumps(cfg: CFG):
+    """
+    End every block that falls through with a `jmp` to its successor, or a
+    `ret` if it falls off the end of the function.
+    """
+    for block in cfg.blocks:
+        if block.terminator() is not None:
+            continue
+        if block.succs:
+            label = cfg.blocks[block.succs[0]].label
+            block.instrs.append({"op": "jmp", "labels": [label]})
+        else:
+            block.instrs.append({"op": "ret"})
+
+
+def thread_jumps(cfg: CFG, stats: Counter):
+    """Retarget branches past blocks that do nothing but jump elsewhere."""
+    forward = {}
+    for block in cfg.blocks:
+        if block.index != 0 and len(block.instrs) == 1:
+            term = block.terminator()
+            if term is not None and term["op"] == "jmp":
+                forward[block.label] = term["labels"][0]
+
+    def resolve(label):
+        seen = {label}
+        while label in forward and forward[label] not in seen:
+            label = forward[label]
+            seen.add(label)
+        return label
+
+    for block in cfg.blocks:
+        term = block.terminator()
+        if term is None or term["op"] not in ("jmp", "br"):
+            continue
+        labels = [resolve(label) for label in term["labels"]]
+        if labels != term["labels"]:
+            stats["jumps threaded"] += sum(
+                a != b for a, b in zip(labels, term["labels"])
+            )
+            term["labels"] = labels
+        if term["op"] == "br" and labels[0] == labels[1]:
+            block.instrs[-1] = {"op": "jmp", "labels": [labels[0]]}
+            stats["branches folded"] += 1
+    cfg.link()
+
+
+def reachable(cfg: CFG) -> list[bool]:
+    seen = [False] * len(cfg.blocks)
+    seen[0] = True
+    work = [0]
+    while work:
+        for s in cfg.blocks[work.pop()].succs:
+            if not seen[s]:
+                seen[s] = True
+                work.append(s)
+    return seen
+
+
+def place_blocks(cfg: CFG, order: list[int]):
+    """Reorder the blocks, dropping any not in `order`."""
+    blocks = [cfg.blocks[b] for b in order]
+    for i, block in enumerate(blocks):
+        block.index = i
+    cfg.blocks = blocks
+    cfg.link()
+
+
+def chains(cfg: CFG) -> list[list[int]]:
+    """
+    Greedily chain blocks along their most likely edges. Back edges go
+    first so that each loop ends in its latch falling into the header,
+    which leaves one taken branch per iteration; then edges by loop depth,
+    preferring the original order. The entry block always starts a chain.
+    """
+    loops = cfg.loops()
+    depth = cfg.loop_depths(loops)
+    back = {(latch, loop.header) for loop in loops for latch in loop.latches}
+
+    edges = [(b.index, s) for b in cfg.blocks for s in b.succs if s != 0]
+    edges.sort(
+        key=lambda e: (e in back, min(depth[e[0]], depth[e[1]]), e[1] == e[0] + 1),
+        reverse=True,
+    )
+
+    chain_of = {b.index: [b.index] for b in cfg.blocks}
+    for src, dst in edges:
+        head, tail = chain_of[dst], chain_of[src]
+        if head is tail or tail[-1] != src or head[0] != dst:
+            continue
+        tail.extend(head)
+        for b in head:
+            chain_of[b] = tail
+
+    seen = set()
+    result = []
+    for b in range(len(cfg.blocks)):
+        chain = chain_of[b]
+        if id(chain) not in seen:
+            seen.add(id(chain))
+            result.append(chain)
+    return result
+
+
+def layout(cfg: CFG) -> Counter:
+    """
+    Thread jumps, drop blocks that became unreachable and lay the rest out
+    so that likely successors fall through. Jumps to the next block are
+    removed, so lowering only branches where it has to.
+    """
+    stats = Counter()
+    explicit_jumps(cfg)
+    thread_jumps(cfg, stats)
+
+    live = reachable(cfg)
+    stats["blocks removed"] += live.count(False)
+    place_blocks(cfg, [b for b in range(len(cfg.blocks)) if live[b]])
+
+    order = [b for chain in chains(cfg) for b in chain]
+    stats["blocks moved"] += sum(a != b for a, b in enumerate(order))
+    place_blocks(cfg, order)
+
+    for block in cfg.blocks[:-1]:
+        term = block.terminator()
+        if term is not None and term["op"] == "jmp":
+            if term["labels"][0] == cfg.blocks[block.index + 1].label:
+                block.instrs.pop()
+    cfg.link()
+    return stats
@@ -0,0 +1,261 @@
+from cfg import CFG, BasicBlock, Loop
+from layout import place_blocks
+from sccp import BOTTOM, fold
+
+# same marker as ssa.UNDEFINED, which imports this module
+UNDEFINED = "__undefined"
+
+# pure operations that can run speculatively; div only with a non-zero
+# constant divisor, see `hoistable`
+INVARIANT_OPS = {"const", "id", "add", "sub", "mul", "div", "eq", "lt", "gt", "le"}
+INVARIANT_OPS |= {"ge", "not", "and", "or", "select", "ptradd"}
+INVARIANT_OPS |= {"fadd", "fsub", "fmul", "fdiv", "feq", "flt", "fgt", "fle", "fge"}
+
+
+def phis(block: BasicBlock):
+    for instr in block.instrs:
+        if instr["op"] != "phi":
+            break
+        yield instr
+
+
+def insert_preheaders(cfg: CFG, names) -> int:
+    """
+    Give every loop header a single predecessor from outside the loop that
+    only jumps to it. Phi arguments from outside are merged there. Returns
+    the number of blocks added. Each preheader goes right before its
+    header; blocks are only renumbered once all are in.
+    """
+    added = {}
+    for loop in cfg.loops():
+        header = cfg.blocks[loop.header]
+        outside = [p for p in header.preds if p not in loop.blocks]
+        if len(outside) == 1 and len(cfg.blocks[outside[0]].succs) == 1:
+            continue
+
+        pre = BasicBlock(len(cfg.blocks), names.fresh(header.label, label=True), [])
+        outside_labels = {cfg.blocks[p].label for p in outside}
+        for phi in phis(header):
+            pairs = list(zip(phi["args"], phi["labels"]))
+            out = [(a, l) for a, l in pairs if l in outside_labels]
+            merged = names.fresh(phi["dest"])
+            pre.instrs.append(
+                {
+                    "dest": merged,
+                    "op": "phi",
+                    "type": phi["type"],
+                    "args": [a for a, _ in out],
+                    "labels": [l for _, l in out],
+                }
+            )
+            inside = [(a, l) for a, l in pairs if l not in outside_labels]
+            phi["args"] = [merged] + [a for a, _ in inside]
+            phi["labels"] = [pre.label] + [l for _, l in inside]
+
+        for p in outside:
+            term = cfg.blocks[p].terminator()
+            if term is not None and "labels" in term:
+                term["labels"] = [
+                    pre.label if l == header.label else l for l in term["labels"]
+                ]
+
+        # the block before the header may fall into it; if it's part of the
+        # loop it must keep going to the header, not the preheader
+        before = cfg.blocks[loop.header - 1]
+        if before.index in loop.blocks and before.terminator() is None:
+            before.instrs.append({"op": "jmp", "labels": [header.label]})
+
+        cfg.blocks.append(pre)
+        added[loop.header] = pre.index
+
+    if added:
+        order = []
+        for b in range(len(cfg.blocks) - len(added)):
+            if b in added:
+                order.append(added[b])
+            order.append(b)
+        place_blocks(cfg, order)
+    return len(added)
+
+
+def preheader(cfg: CFG, loop: Loop) -> BasicBlock:
+    header = cfg.blocks[loop.header]
+    (pre,) = [p for p in header.preds if p not in loop.blocks]
+    return cfg.blocks[pre]
+
+
+def append_before_terminator(block: BasicBlock, instrs: list[dict]):
+    at = len(block.instrs) - (block.terminator() is not None)
+    block.instrs[at:at] = instrs
+
+
+def constants(cfg: CFG) -> dict:
+    return {
+        instr["dest"]: instr["value"]
+        for instr in cfg.instructions()
+        if instr.get("op") == "const"
+    }
+
+
+def hoistable(instr, defined, consts) -> bool:
+    op = instr.get("op")
+    if "dest" not in instr or op not in INVARIANT_OPS:
+        return False
+    if op == "div" and consts.get(instr["args"][1], 0) == 0:
+        return False
+    return not any(a in defined for a in instr.get("args", []))
+
+
+def loop_defs(cfg: CFG, loop: Loop) -> dict:
+    """Variables defined in the loop -> (block, instruction)."""
+    return {
+        instr["dest"]: (block, instr)
+        for block in (cfg.blocks[b] for b in loop.blocks)
+        for instr in block.instrs
+        if "dest" in instr
+    }
+
+
+def licm(cfg: CFG) -> int:
+    """
+    Move pure instructions whose operands don't change in a loop to its
+    preheader, innermost loops first so that values can climb out of
+    several loops. Expects SSA with preheaders. Returns how many moved.
+    """
+    moved = 0
+    consts = constants(cfg)
+    rpo = cfg.reverse_postorder()
+    for loop in sorted(cfg.loops(), key=lambda l: l.depth, reverse=True):
+        defined = set(loop_defs(cfg, loop))
+        hoisted = []
+        changed = True
+        while changed:
+            changed = False
+            for b in rpo:
+                if b not in loop.blocks:
+                    continue
+                block = cfg.blocks[b]
+                kept = []
+                for instr in block.instrs:
+                    if hoistable(instr, defined, consts):
+                        hoisted.append(instr)
+                        defined.discard(instr["dest"])
+                        changed = True
+                    else:
+                        kept.append(instr)
+                block.instrs = kept
+        append_before_terminator(preheader(cfg, loop), hoisted)
+        moved += len(hoisted)
+    return moved
+
+
+def basic_ivs(cfg: CFG, loop: Loop, defs) -> dict:
+    """
+    Header phis that step by a loop-invariant amount every iteration:
+    phi -> (initial value, step, "add" or "sub", next value).
+    """
+    pre = preheader(cfg, loop).label
+    ivs = {}
+    for phi in phis(cfg.blocks[loop.header]):
+        init = [a for a, l in zip(phi["args"], phi["labels"]) if l == pre]
+        nexts = {a for a, l in zip(phi["args"], phi["labels"]) if l != pre}
+        if len(nexts) != 1 or init == [UNDEFINED]:
+            continue
+        nxt = nexts.pop()
+        if nxt not in defs:
+            continue
+        instr = defs[nxt][1]
+        match instr["op"], instr.get("args"):
+            case "add", [a, b] if a == phi["dest"] and b not in defs:
+                ivs[phi["dest"]] = (init[0], b, "add", nxt)
+            case "add", [a, b] if b == phi["dest"] and a not in defs:
+                ivs[phi["dest"]] = (init[0], a, "add", nxt)
+            case "sub", [a, b] if a == phi["dest"] and b not in defs:
+                ivs[phi["dest"]] = (init[0], b, "sub", nxt)
+    return ivs
+
+
+def strength_reduce_ivs(cfg: CFG, names) -> int:
+    """
+    Replace `j = mul i k`, with i a basic induction variable and k loop
+    invariant, by a new induction variable that starts at init * k and
+    steps by step * k alongside i. Wrapping arithmetic makes this exact.
+    The new variables are induction variables themselves, so products of
+    them are reduced too. Returns the number of multiplications replaced.
+    """
+    replaced = 0
+    consts = constants(cfg)
+
+    def product(a, b, block):
+        if a in consts and b in consts:
+            value = fold("mul", [consts[a], consts[b]])
+            instr = {"op": "const", "value": value}
+        else:
+            value = BOTTOM
+            instr = {"op": "mul", "args": [a, b]}
+        dest = names.fresh("iv")
+        instr.update(dest=dest, type="int")
+        if value is not BOTTOM:
+            consts[dest] = value
+        append_before_terminator(block, [instr])
+        return dest
+
+    rpo = cfg.reverse_postorder()
+    for loop in cfg.loops():
+        header = cfg.blocks[loop.header]
+        pre = preheader(cfg, loop)
+        defs = loop_defs(cfg, loop)
+        ivs = basic_ivs(cfg, loop, defs)
+        reduced = {}
+        rename = {}
+        for block in (cfg.blocks[b] for b in rpo):
+            if block.index not in loop.blocks:
+                continue
+            for instr in list(block.instrs):
+                if instr["op"] != "mul":
+                    continue
+                i, k = (rename.get(a, a) for a in instr["args"])
+                if i not in ivs:
+                    i, k = k, i
+                if i not in ivs or k in defs:
+                    continue
+                if (i, k) not in reduced:
+                    init, step, op, nxt = ivs[i]
+                    start = product(init, k, pre)
+                    stride = product(step, k, pre)
+                    phi = names.fresh("iv")
+                    following = names.fresh("iv")
+                    labels = [pre.label] + [
+                        cfg.blocks[p].label for p in header.preds if p != pre.index
+                    ]
+                    header.instrs.insert(
+                        0,
+                        {
+                            "dest": phi,
+                            "op": "phi",
+                            "type": "int",
+                            "args": [start] + [following] * (len(labels) - 1),
+                            "labels": labels,
+                        },
+                    )
+                    where, at = defs[nxt]
+                    update = {
+                        "dest": following,
+                        "op": op,
+                        "type": "int",
+                        "args": [phi, stride],
+                    }
+                    where.instrs.insert(where.instrs.index(at) + 1, update)
+                    defs[phi] = (header, header.instrs[0])
+                    defs[following] = (where, update)
+                    ivs[phi] = (start, stride, op, following)
+                    reduced[(i, k)] = phi
+                rename[instr["dest"]] = reduced[(i, k)]
+                block.instrs.remove(instr)
+                replaced += 1
+
+        if rename:
+            for instr in cfg.instructions():
+                if "args" in instr:
+                    instr["args"] = [rename.get(a, a) for a in instr["args"]]
+    return replaced
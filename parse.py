@@ -0,0 +1,135 @@
+import re
+
+# comments, punctuation, and words: names, @functions, .labels and literals;
+# a function name ends the word before it, as in `call@f`
+TOKEN = re.compile(r"#[^\n]*|[{}();:=,<>]|@?[^\s{}();:=,<>#@]+")
+
+
+class ParseError(Exception):
+    pass
+
+
+def tokenize(source: str) -> list[str]:
+    return [t for t in TOKEN.findall(source) if t[0] != "#"]
+
+
+def literal(token: str):
+    if token in ("true", "false"):
+        return token == "true"
+    if token[0] == "'" and token[-1] == "'":
+        return token[1:-1]
+    try:
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(token)
+    except ValueError:
+        raise ParseError(f"bad literal {token!r}") from None
+
+
+def parse_type(tokens: list[str], i: int):
+    """The type starting at tokens[i] and the index after it."""
+    name = tokens[i]
+    if i + 1 < len(tokens) and tokens[i + 1] == "<":
+        inner, i = parse_type(tokens, i + 2)
+        if tokens[i] != ">":
+            raise ParseError(f"expected '>' after {name} type, got {tokens[i]!r}")
+        return {name: inner}, i + 1
+    return name, i + 1
+
+
+def operation(words: list[str]) -> dict:
+    instr = {"op": words[0]}
+    args, funcs, labels = [], [], []
+    for word in words[1:]:
+        if word[0] == "@":
+            funcs.append(word[1:])
+        elif word[0] == ".":
+            labels.append(word[1:])
+        else:
+            args.append(word)
+    # like bril2json, every operation gets args, even an empty list
+    instr["args"] = args
+    if funcs:
+        instr["funcs"] = funcs
+    if labels:
+        instr["labels"] = labels
+    return instr
+
+
+def instruction(stmt: list[str]) -> dict:
+    """One statement, without its semicolon."""
+    if len(stmt) < 2 or stmt[1] not in (":", "="):
+        return operation(stmt)
+    instr = {"dest": stmt[0]}
+    i = 1
+    if stmt[1] == ":":
+        instr["type"], i = parse_type(stmt, 2)
+    if i >= len(stmt) or stmt[i] != "=" or i + 1 >= len(stmt):
+        raise ParseError(f"malformed instruction {' '.join(stmt)!r}")
+    if stmt[i + 1] == "const":
+        if len(stmt) != i + 3:
+            raise ParseError(f"malformed constant {' '.join(stmt)!r}")
+        instr["op"] = "const"
+        instr["value"] = literal(stmt[i + 2])
+        return instr
+    instr.update(operation(stmt[i + 1 :]))
+    return instr
+
+
+def parse_function(tokens: list[str], i: int):
+    """The function starting at tokens[i] and the index after it."""
+    func = {"name": tokens[i][1:]}
+    i += 1
+    args = []
+    if tokens[i] == "(":
+        i += 1
+        while tokens[i] != ")":
+            if tokens[i + 1] != ":":
+                raise ParseError(f"expected ':' after argument {tokens[i]!r}")
+            typ, j = parse_type(tokens, i + 2)
+            args.append({"name": tokens[i], "type": typ})
+            i = j + (tokens[j] == ",")
+        i += 1
+    if args:
+        func["args"] = args
+    if tokens[i] == ":":
+        func["type"], i = parse_type(tokens, i + 1)
+    if tokens[i] != "{":
+        raise ParseError(f"expected '{{' to start @{func['name']}, got {tokens[i]!r}")
+    i += 1
+
+    instrs = []
+    while tokens[i] != "}":
+        if tokens[i][0] == "." and tokens[i + 1] == ":":
+            instrs.append({"label": tokens[i][1:]})
+            i += 2
+            continue
+        end = tokens.index(";", i)
+        if "}" in tokens[i:end]:
+            raise ParseError(f"missing ';' in @{func['name']}")
+        if end > i:
+            instrs.append(instruction(tokens[i:end]))
+        i = end + 1
+    func["instrs"] = instrs
+    return func, i + 1
+
+
+def parse_program(source: str) -> dict:
+    """
+    Parse Bril's text form into the same JSON structure bril2json produces.
+    Imports and structs aren't supported.
+    """
+    tokens = tokenize(source)
+    functions = []
+    i = 0
+    try:
+        while i < len(tokens):
+            if tokens[i][0] != "@":
+                raise ParseError(f"expected a function, got {tokens[i]!r}")
+            func, i = parse_function(tokens, i)
+            functions.append(func)
+    except (IndexError, ValueError) as e:
+        raise ParseError("unexpected end of program") from e
+    return {"functions": functions}
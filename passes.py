@@ -0,0 +1,189 @@
+import json
+import time
+import tracemalloc
+
+from collections import Counter
+
+from cfg import CFG
+from x86 import Function, Program
+
+
+def size(unit):
+    """Instructions in what a pass works on, or None if it isn't code."""
+    if isinstance(unit, tuple):
+        # passes such as inlining return the program and a report
+        unit = unit[0]
+    if isinstance(unit, CFG):
+        return sum(len(b.instrs) for b in unit.blocks)
+    if isinstance(unit, Function):
+        return len(unit.instructions)
+    if isinstance(unit, Program):
+        return sum(len(f.instructions) for f in unit.functions)
+    if isinstance(unit, dict) and "functions" in unit:
+        return sum(len(f["instrs"]) for f in unit["functions"])
+    return None
+
+
+def unit_name(unit):
+    """The function a pass works on, or None for the whole program."""
+    if isinstance(unit, (CFG, Function)):
+        return unit.name
+    return None
+
+
+class Hook:
+    """Sees every pass the manager runs. The methods do nothing by default."""
+
+    def before(self, name: str, unit):
+        pass
+
+    def after(self, name: str, unit, result):
+        pass
+
+    def count(self, name: str, counters: Counter):
+        pass
+
+
+class PassManager:
+    """
+    Runs the compiler's passes by name, so hooks can watch them. Without
+    hooks, running a pass is a plain call.
+    """
+
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+
+    def run(self, name: str, func, unit, *args):
+        """`func(unit, *args)` as the pass `name`."""
+        if not self.hooks:
+            return func(unit, *args)
+        for hook in self.hooks:
+            hook.before(name, unit)
+        result = func(unit, *args)
+        for hook in reversed(self.hooks):
+            hook.after(name, unit, result)
+        return result
+
+    def count(self, name: str, counters: Counter):
+        """Report counters a pass keeps outside its result."""
+        for hook in self.hooks:
+            hook.count(name, counters)
+
+
+class PassStats(Hook):
+    """
+    Wall time, peak traced memory, instruction counts and counters per
+    pass. Passes may nest; a pass's time and memory include its children.
+    Counters are the pass's result when it's a Counter, or "changes" when
+    it's a number.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.passes = {}
+        self.functions = []
+        # (start time, instructions, peak memory so far) of running passes
+        self.running = []
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+
+    def before(self, name: str, unit):
+        if self.running:
+            # resetting the peak below would lose the enclosing pass's
+            start, count, peak = self.running[-1]
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            self.running[-1] = (start, count, peak)
+        # listed in the order they first start, so enclosing passes come first
+        if name not in self.passes:
+            self.passes[name] = {
+                "name": name,
+                "depth": len(self.running),
+                "runs": 0,
+                "time": 0.0,
+                "peak_memory": 0,
+                "instructions_in": None,
+                "instructions_out": None,
+                "counters": Counter(),
+            }
+        tracemalloc.reset_peak()
+        self.running.append((time.perf_counter(), size(unit), 0))
+
+    def after(self, name: str, unit, result):
+        start, count_in, peak = self.running.pop()
+        elapsed = time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        if self.running:
+            outer_start, outer_count, outer_peak = self.running[-1]
+            self.running[-1] = (outer_start, outer_count, max(outer_peak, peak))
+
+        # passes that rewrite their input in place return counts, if anything
+        count_out = size(result)
+        if count_out is None:
+            count_out = size(unit)
+        stats = self.passes[name]
+        stats["runs"] += 1
+        stats["time"] += elapsed
+        stats["peak_memory"] = max(stats["peak_memory"], peak)
+        if count_in is not None:
+            stats["instructions_in"] = (stats["instructions_in"] or 0) + count_in
+            stats["instructions_out"] = (stats["instructions_out"] or 0) + count_out
+        if isinstance(result, Counter):
+            self.count(name, result)
+        elif isinstance(result, int) and not isinstance(result, bool):
+            stats["counters"]["changes"] += result
+
+        function = unit_name(unit)
+        if function is not None:
+            self.functions.append(
+                {
+                    "pass": name,
+                    "function": function,
+                    "time": elapsed,
+                    "instructions_in": count_in,
+                    "instructions_out": count_out,
+                }
+            )
+
+    def count(self, name: str, counters: Counter):
+        if name in self.passes:
+            self.passes[name]["counters"].update(counters)
+
+    def finish(self):
+        """Stop tracing memory, if this started it."""
+        self.total = time.perf_counter() - self.start
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def report(self) -> list[str]:
+        lines = [
+            f"{'pass':<24}{'runs':>6}{'time (ms)':>12}{'%':>7}"
+            f"{'peak KiB':>10}  instructions"
+        ]
+        for stats in self.passes.values():
+            name = "  " * stats["depth"] + stats["name"]
+            share = 100 * stats["time"] / self.total if self.total else 0
+            line = (
+                f"{name:<24}{stats['runs']:>6}{stats['time'] * 1000:>12.2f}"
+                f"{share:>6.1f}%{stats['peak_memory'] / 1024:>10.0f}"
+            )
+            if stats["instructions_in"] is not None:
+                line += f"  {stats['instructions_in']} -> {stats['instructions_out']}"
+            lines.append(line)
+            for counter, value in sorted(stats["counters"].items()):
+                lines.append(f"{'  ' * (stats['depth'] + 2)}{counter}: {value}")
+        lines.append(f"{'total':<30}{self.total * 1000:>12.2f}")
+        return lines
+
+    def write_json(self, path: str):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "total_time": self.total,
+                    "passes": list(self.passes.values()),
+                    "functions": self.functions,
+                },
+                f,
+                indent=2,
+            )
@@ -0,0 +1,191 @@
+from collections import Counter
+
+from x86 import (
+    Binary,
+    Cmov,
+    Cmp,
+    Cqo,
+    Div,
+    Function,
+    Instruction,
+    Jump,
+    JumpCond,
+    Label,
+    Lea,
+    Mov,
+    Mul,
+    Ret,
+    TailCall,
+    Test,
+    Ucomisd,
+    Unary,
+)
+
+# how far forward dead-store looks for an overwrite
+WINDOW = 8
+# moves that write all 8 bytes of their destination, so only they can
+# make an earlier store to it dead
+FULL_WIDTH = {"q", "absq", "sd"}
+
+SUBREGISTERS = {"%al": "%rax", "%eax": "%rax", "%dl": "%rdx", "%edx": "%rdx"}
+
+
+def canonical(operand: str) -> str:
+    return SUBREGISTERS.get(operand, operand)
+
+
+def effects(instr: Instruction):
+    """
+    Return (reads, writes) operand tuples of a straight-line instruction, or
+    None if it transfers control, touches %rsp or calls out.
+    """
+    kind = type(instr)
+    if kind is Mov:
+        return (canonical(instr.src),), (canonical(instr.dest),)
+    if kind is Binary:
+        if isinstance(instr.binary_operator, (Cmp, Test, Ucomisd)):
+            return (instr.src, instr.dest), ()
+        return (instr.src, instr.dest), (instr.dest,)
+    if kind is Unary:
+        operand = canonical(instr.operand)
+        if isinstance(instr.unary_operator, (Div, Mul)):
+            return (operand, "%rax", "%rdx"), ("%rax", "%rdx")
+        # setCC only writes the low byte, so it reads the rest of the register
+        return (operand,), (operand,)
+    if kind is Cmov:
+        # the destination keeps its value when the condition fails
+        return (instr.src, instr.dest), (instr.dest,)
+    if kind is Lea:
+        return (instr.src,), (instr.dest,)
+    if kind is Cqo:
+        return ("%rax",), ("%rdx",)
+    return None
+
+
+def reads(eff, operand: str) -> bool:
+    """
+    Do the `effects` of an instruction read `operand`, either directly or
+    through an address?
+    """
+    if eff is None:
+        return True
+    read, written = eff
+    return any(operand in r for r in read) or any(
+        operand in w for w in written if w != operand
+    )
+
+
+class Peephole:
+    """
+    A pattern-driven rewriter. Each rule looks at the instruction at index i
+    and returns None or (count, replacement) to replace instrs[i:i + count].
+    Rules are keyed by the instruction types they can start at and tried in
+    registration order; the whole list is rescanned until no rule fires.
+    """
+
+    def __init__(self):
+        self.rules: dict[type, list] = {}
+
+    def rule(self, name, *kinds):
+        def register(fn):
+            for kind in kinds:
+                self.rules.setdefault(kind, []).append((name, fn))
+            return fn
+
+        return register
+
+    def run(self, f: Function, hits: Counter) -> Function:
+        instrs = list(f.instructions)
+        changed = True
+        while changed:
+            changed = False
+            out = []
+            i = 0
+            while i < len(instrs):
+                for name, fn in self.rules.get(type(instrs[i]), ()):
+                    result = fn(instrs, i)
+                    if result is not None:
+                        count, replacement = result
+                        hits[name] += 1
+                        out.extend(replacement)
+                        i += count
+                        changed = True
+                        break
+                else:
+                    out.append(instrs[i])
+                    i += 1
+            instrs = out
+        return Function(f.name, instrs)
+
+
+default = Peephole()
+
+
+@default.rule("self-move", Mov)
+def self_move(instrs, i):
+    match instrs[i]:
+        case Mov("q", src, dest) if src == dest:
+            return 1, []
+
+
+@default.rule("redundant-load", Mov)
+def redundant_load(instrs, i):
+    """A store followed by a load of the same value back into the register."""
+    if i + 1 >= len(instrs):
+        return None
+    match instrs[i], instrs[i + 1]:
+        case Mov("q", a, b), Mov("q", c, d) if (c, d) in (
+            (b, a),
+            (a, b),
+        ) and b not in a:
+            return 2, [instrs[i]]
+
+
+@default.rule("dead-store", Mov)
+def dead_store(instrs, i):
+    """A move whose destination is overwritten before anything reads it."""
+    dest = canonical(instrs[i].dest)
+    # stores through pointers may alias each other, and their base may change
+    if dest.endswith(")") and not dest.endswith("(%rsp)"):
+        return None
+    for later in instrs[i + 1 : i + 1 + WINDOW]:
+        eff = effects(later)
+        if reads(eff, dest):
+            return None
+        if dest in eff[1]:
+            if isinstance(later, Mov) and later.t in FULL_WIDTH:
+                return 1, []
+            return None
+    return None
+
+
+@default.rule("jump-to-next", Jump, JumpCond)
+def jump_to_next(instrs, i):
+    match instrs[i]:
+        case Jump(target) | JumpCond(_, target):
+            pass
+        case _:
+            return None
+
+    j = i + 1
+    while j < len(instrs) and isinstance(instrs[j], Label):
+        if instrs[j].name == target:
+            return 1, []
+        j += 1
+    return None
+
+
+@default.rule("unreachable", Jump, Ret, TailCall)
+def unreachable(instrs, i):
+    """Code between an unconditional transfer and the next label."""
+    j = i + 1
+    while j < len(instrs) and not isinstance(instrs[j], Label):
+        j += 1
+    if j == i + 1:
+        return None
+    return j - i, [instrs[i]]
+
+
+def peephole(f: Function, hits: Counter, optimizer: Peephole = default) -> Function:
+    """Rewrite `f` with `optimizer`'s rules, counting rule hits into `hits`."""
+    return optimizer.run(f, hits)
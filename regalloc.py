@@ -0,0 +1,227 @@
+import bisect
+import heapq
+from dataclasses import dataclass, field
+
+from cfg import CFG, liveness
+from x86 import stack_slot
+
+CALLEE_SAVED = ["%rbx", "%r12", "%r13", "%r14", "%r15"]
+CALLER_SAVED = ["%rcx", "%r8", "%r9", "%r10", "%r11"]
+# floats live in SSE registers, which calls all clobber; %xmm0 carries
+# return values and %xmm15 is scratch
+FLOAT_REGS = [f"%xmm{i}" for i in range(1, 15)]
+
+CALL_OPS = ("call", "print", "alloc", "free")
+
+
+@dataclass
+class Allocation:
+    # var -> "%reg" or "off(%rsp)"
+    locations: dict[str, str]
+    # var held in a caller-saved register -> stack slot it is saved to around calls
+    homes: dict[str, str] = field(default_factory=dict)
+    # position of a call or runtime call -> vars that must be saved around it
+    crossing: dict[int, list[str]] = field(default_factory=dict)
+    # callee-saved register -> stack slot it is preserved in
+    callee_saved: dict[str, str] = field(default_factory=dict)
+    frame_size: int = 0
+    # frame size if no two stack values shared a slot
+    unshared_frame_size: int = 0
+
+
+def is_reg(loc: str) -> bool:
+    return loc.startswith("%")
+
+
+def live_intervals(cfg: CFG, skip=()):
+    """
+    Compute one [start, end] interval per variable over the linear positions
+    assigned by `CFG.number`; arguments are defined at 0. Variables in `skip`
+    are left out.
+    """
+    # positions only grow as we walk the blocks, so the first position that
+    # touches a variable is its start and the last one is its end
+    lo = {arg["name"]: 0 for arg in cfg.args}
+    hi = dict(lo)
+
+    cfg.number()
+    live_in, live_out = liveness(cfg)
+    for block in cfg.blocks:
+        for var in live_in[block.index]:
+            lo.setdefault(var, block.start)
+
+        for k, instr in enumerate(block.instrs):
+            pos = block.start + k + 1
+            for a in instr.get("args", []):
+                lo.setdefault(a, pos)
+                hi[a] = pos
+            if "dest" in instr:
+                lo.setdefault(instr["dest"], pos)
+                hi[instr["dest"]] = pos
+
+        hi.update(dict.fromkeys(live_out[block.index], block.start + len(block.instrs)))
+
+    return {var: [lo[var], hi.get(var, lo[var])] for var in lo if var not in skip}
+
+
+def call_sites(cfg: CFG):
+    return [
+        block.start + k + 1
+        for block in cfg.blocks
+        for k, instr in enumerate(block.instrs)
+        if instr.get("op") in CALL_OPS
+    ]
+
+
+def crossed_calls(interval, calls):
+    """
+    Positions in the sorted `calls` list that clobber a variable living over
+    `interval`. A call reads all its arguments before it is made, print
+    included, so a variable whose interval ends at a call isn't clobbered.
+    """
+    start, end = interval
+    i = bisect.bisect_right(calls, start)
+    while i < len(calls) and calls[i] < end:
+        yield calls[i]
+        i += 1
+
+
+def linear_scan(intervals, calls, callee_saved=CALLEE_SAVED, caller_saved=CALLER_SAVED):
+    """
+    Poletto-Sarkar linear scan. Intervals that live across a call prefer
+    callee-saved registers; the rest prefer caller-saved ones. Returns a
+    var -> register mapping; spilled vars are absent.
+    """
+    order = sorted(intervals, key=lambda v: (intervals[v][0], intervals[v][1]))
+    crossing_call = {
+        v: next(crossed_calls(intervals[v], calls), None) is not None for v in intervals
+    }
+
+    assignment = {}
+    active = []
+    free = set(callee_saved + caller_saved)
+
+    for var in order:
+        start, end = intervals[var]
+        for other in list(active):
+            if intervals[other][1] < start:
+                active.remove(other)
+                free.add(assignment[other])
+
+        prefs = callee_saved + caller_saved
+        if not crossing_call[var]:
+            prefs = caller_saved + callee_saved
+        reg = next((r for r in prefs if r in free), None)
+
+        if reg is not None:
+            free.remove(reg)
+            assignment[var] = reg
+            active.append(var)
+            continue
+
+        victim = max(active, key=lambda v: intervals[v][1])
+        if intervals[victim][1] > end:
+            assignment[var] = assignment.pop(victim)
+            active.remove(victim)
+            active.append(var)
+
+    return assignment
+
+
+class FrameBuilder:
+    def __init__(self):
+        self.size = 0
+
+    def slot(self) -> str:
+        off = self.size
+        self.size += 8
+        return stack_slot(off)
+
+    def shared_slots(self, intervals, share=True):
+        """
+        Give every key of `intervals` a slot. With `share`, a key reuses a
+        slot whose previous owner's interval ended strictly before its own
+        started, so values with disjoint lifetimes occupy the same memory.
+        """
+        if not share:
+            return {key: self.slot() for key in intervals}
+
+        slots = {}
+        free = []
+        active = []
+        order = sorted(intervals, key=lambda k: intervals[k][0])
+        for key in order:
+            start, end = intervals[key]
+            while active and active[0][0] < start:
+                _, slot = heapq.heappop(active)
+                heapq.heappush(free, slot)
+            if free:
+                slot = heapq.heappop(free)
+            else:
+                slot = self.size
+                self.size += 8
+            slots[key] = stack_slot(slot)
+            heapq.heappush(active, (end, slot))
+        return slots
+
+
+def variables(cfg: CFG, skip=()):
+    names = [arg["name"] for arg in cfg.args]
+    seen = set(names) | set(skip)
+    for block in cfg.blocks:
+        for instr in block.instrs:
+            if "dest" in instr and instr["dest"] not in seen:
+                seen.add(instr["dest"])
+                names.append(instr["dest"])
+    return names
+
+
+def stack_allocation(cfg: CFG, share_slots=True, skip=()) -> Allocation:
+    """Keep every variable not in `skip` on the stack."""
+    names = variables(cfg, skip)
+    intervals = live_intervals(cfg, skip) if share_slots else dict.fromkeys(names)
+    frame = FrameBuilder()
+    locations = frame.shared_slots({var: intervals[var] for var in names}, share_slots)
+    return Allocation(
+        locations, frame_size=frame.size, unshared_frame_size=8 * len(names)
+    )
+
+
+def register_allocation(cfg: CFG, share_slots=True, skip=(), floats=()) -> Allocation:
+    """Variables in `floats` go to FLOAT_REGS, the rest to general registers."""
+    intervals = live_intervals(cfg, skip)
+    calls = call_sites(cfg)
+    assignment = linear_scan(
+        {v: i for v, i in intervals.items() if v not in floats}, calls
+    )
+    assignment |= linear_scan(
+        {v: i for v, i in intervals.items() if v in floats}, calls, [], FLOAT_REGS
+    )
+
+    alloc = Allocation({})
+    on_stack = {}
+    for var in variables(cfg, skip):
+        if var in assignment:
+            alloc.locations[var] = assignment[var]
+        else:
+            on_stack[("spill", var)] = intervals[var]
+
+        if assignment.get(var) in CALLER_SAVED + FLOAT_REGS:
+            for pos in crossed_calls(intervals[var], calls):
+                alloc.crossing.setdefault(pos, []).append(var)
+                on_stack[("home", var)] = intervals[var]
+
+    frame = FrameBuilder()
+    for (kind, var), slot in frame.shared_slots(on_stack, share_slots).items():
+        if kind == "spill":
+            alloc.locations[var] = slot
+        else:
+            alloc.homes[var] = slot
+
+    for reg in CALLEE_SAVED:
+        if reg in assignment.values():
+            alloc.callee_saved[reg] = frame.slot()
+
+    alloc.frame_size = frame.size
+    alloc.unshared_frame_size = 8 * (len(on_stack) + len(alloc.callee_saved))
+    return alloc
@@ -5,11 +5,93 @@
 #include <math.h>
 #include <stdlib.h>
 
+// print output is collected here and written out when full or at exit,
+// or after every print if BRIL_UNBUFFERED is set
+static char out[1 << 16];
+static size_t out_len;
+static int unbuffered = -1;
+
+static void flush_out(void) {
+    fwrite(out, 1, out_len, stdout);
+    out_len = 0;
+}
+
+static void put_int(int64_t i) {
+    char digits[20];
+    int n = 0;
+    uint64_t u = i < 0 ? -(uint64_t)i : (uint64_t)i;
+    do {
+        digits[n++] = '0' + u % 10;
+        u /= 10;
+    } while (u);
+    if (i < 0) {
+        out[out_len++] = '-';
+    }
+    while (n) {
+        out[out_len++] = digits[--n];
+    }
+}
+
+static void put_float(double f) {
+    const char *text = NULL;
+    if (isnan(f)) {
+        text = "NaN";
+    } else if (isinf(f)) {
+        text = f < 0 ? "-Infinity" : "Infinity";
+    }
+    if (text) {
+        memcpy(out + out_len, text, strlen(text));
+        out_len += strlen(text);
+    } else if ((f != 0.0) && ((fabs(f) >= 1E10) || (fabs(f) <= 1E-10))) {
+        out_len += sprintf(out + out_len, "%.17e", f);
+    } else {
+        out_len += sprintf(out + out_len, "%.17lf", f);
+    }
+}
+
+// one call per print: values[k] has type types[k], 'i', 'b' or 'f'; floats
+// are passed as their bits
+void _bril_print_n(const int64_t *values, const char *types, int64_t n) {
+    if (unbuffered < 0) {
+        unbuffered = getenv("BRIL_UNBUFFERED") != NULL;
+        atexit(flush_out);
+    }
+    for (int64_t k = 0; k < n; k++) {
+        // room for the longest value and a separator
+        if (out_len + 32 > sizeof out) {
+            flush_out();
+        }
+        if (types[k] == 'b') {
+            memcpy(out + out_len, values[k] ? "true" : "false", 5);
+            out_len += values[k] ? 4 : 5;
+        } else if (types[k] == 'f') {
+            double f;
+            memcpy(&f, &values[k], sizeof f);
+            put_float(f);
+        } else {
+            put_int(values[k]);
+        }
+        out[out_len++] = k < n - 1 ? ' ' : '\n';
+    }
+    if (n == 0) {
+        if (out_len == sizeof out) {
+            flush_out();
+        }
+        out[out_len++] = '\n';
+    }
+    if (unbuffered) {
+        flush_out();
+        fflush(stdout);
+    }
+}
+
 void _bril_print_int(int64_t i) {
+    flush_out();
     printf("%" PRId64, i);
 }
 
 void _bril_print_bool(char i) {
+    flush_out();
     if (i) {
         printf("true");
     } else {
@@ -18,6 +100,7 @@ void _bril_print_bool(char i) {
 }
 
 void _bril_print_float(double f) {
+    flush_out();
     if (isnan(f)) {
         printf("NaN");
     } else if (isinf(f)) {
@@ -34,10 +117,12 @@ void _bril_print_float(double f) {
 }
 
 void _bril_print_sep() {
+    flush_out();
     printf(" ");
 }
 
 void _bril_print_end() {
+    flush_out();
     printf("\n");
 }
 
@@ -66,4 +151,45 @@ void *_bril_alloc(int64_t size, int64_t bytes) {
 
 void _bril_free(void *ptr) {
     free(ptr);
-}
\ No newline at end of file
+}
+// size-class arena: blocks up to ARENA_MAX bytes, header included, are cut
+// from big chunks and go back on a free list for their class of 16 bytes;
+// larger ones come from malloc. The header holds the class, 0 for malloc.
+#define ARENA_CHUNK (1 << 20)
+#define ARENA_MAX 4096
+static void *arena_free_lists[ARENA_MAX / 16 + 1];
+static char *arena_next, *arena_end;
+
+void *_bril_arena_alloc(int64_t size, int64_t bytes) {
+    size_t total = ((size_t)(size * bytes) + 8 + 15) & ~(size_t)15;
+    int64_t *block;
+    if (total > ARENA_MAX) {
+        block = malloc(total);
+        block[0] = 0;
+        return block + 1;
+    }
+    size_t class = total / 16;
+    if (arena_free_lists[class]) {
+        block = arena_free_lists[class];
+        arena_free_lists[class] = *(void **)(block + 1);
+    } else {
+        if ((size_t)(arena_end - arena_next) < total) {
+            arena_next = malloc(ARENA_CHUNK);
+            arena_end = arena_next + ARENA_CHUNK;
+        }
+        block = (int64_t *)arena_next;
+        arena_next += total;
+    }
+    block[0] = class;
+    return block + 1;
+}
+
+void _bril_arena_free(void *ptr) {
+    int64_t *block = (int64_t *)ptr - 1;
+    if (block[0] == 0) {
+        free(block);
+        return;
+    }
+    *(void **)ptr = arena_free_lists[block[0]];
+    arena_free_lists[block[0]] = block;
+}
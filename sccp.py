@@ -0,0 +1,191 @@
+from collections import Counter
+
+from cfg import CFG, BasicBlock
+
+# lattice values besides constants: no definition seen yet, or not constant
+TOP = object()
+BOTTOM = object()
+
+INT_MIN = -(2**63)
+
+
+def wrap(val: int) -> int:
+    """Reduce to a signed 64-bit integer."""
+    val &= 2**64 - 1
+    return val - 2**64 if val >= 2**63 else val
+
+
+def fold(op, vals):
+    """Evaluate a pure Bril operation on constants, or return BOTTOM."""
+    match op, vals:
+        case "id", [a]:
+            return a
+        case "add", [a, b]:
+            return wrap(a + b)
+        case "sub", [a, b]:
+            return wrap(a - b)
+        case "mul", [a, b]:
+            return wrap(a * b)
+        case "div", [a, b]:
+            # leave traps to run time
+            if b == 0 or (a == INT_MIN and b == -1):
+                return BOTTOM
+            q = abs(a) // abs(b)
+            return q if (a < 0) == (b < 0) else -q
+        case "eq", [a, b]:
+            return a == b
+        case "lt", [a, b]:
+            return a < b
+        case "gt", [a, b]:
+            return a > b
+        case "le", [a, b]:
+            return a <= b
+        case "ge", [a, b]:
+            return a >= b
+        case "not", [a]:
+            return not a
+        case "and", [a, b]:
+            return a and b
+        case "or", [a, b]:
+            return a or b
+    return BOTTOM
+
+
+FOLDABLE = {"id", "add", "sub", "mul", "div", "eq", "lt", "gt", "le", "ge"}
+FOLDABLE |= {"not", "and", "or"}
+
+
+def evaluate(instr, env):
+    op = instr["op"]
+    if op == "const":
+        return instr["value"]
+    if op not in FOLDABLE:
+        return BOTTOM
+    vals = [env.get(a, TOP) for a in instr.get("args", [])]
+    if any(v is BOTTOM for v in vals):
+        return BOTTOM
+    if any(v is TOP for v in vals):
+        return TOP
+    return fold(op, vals)
+
+
+def meet(a, b):
+    if a is TOP:
+        return b
+    if b is TOP or a is b:
+        return a
+    if a is BOTTOM or b is BOTTOM:
+        return BOTTOM
+    if type(a) is type(b) and a == b:
+        return a
+    return BOTTOM
+
+
+def branch_targets(block: BasicBlock, env, by_label):
+    term = block.terminator()
+    if term is None:
+        return block.succs
+    if term["op"] == "br":
+        cond = env.get(term["args"][0], TOP)
+        if cond is not TOP and cond is not BOTTOM:
+            return [by_label[term["labels"][0 if cond else 1]]]
+    return block.succs
+
+
+def propagate(cfg: CFG):
+    """
+    Conditional constant propagation over the CFG. Returns the variable
+    environment at the entry of every executable block; blocks never reached
+    map to None.
+    """
+    by_label = {b.label: b.index for b in cfg.blocks if b.label is not None}
+    entry = {arg["name"]: BOTTOM for arg in cfg.args}
+    state = [None] * len(cfg.blocks)
+    state[0] = entry
+    work = [0]
+    queued = {0}
+    while work:
+        b = work.pop()
+        queued.discard(b)
+        block = cfg.blocks[b]
+        env = dict(state[b])
+        for instr in block.instrs:
+            if "dest" in instr:
+                env[instr["dest"]] = evaluate(instr, env)
+
+        for s in branch_targets(block, env, by_label):
+            if state[s] is None:
+                new = dict(env)
+            else:
+                new = dict(state[s])
+                for var in new.keys() | env.keys():
+                    new[var] = meet(new.get(var, TOP), env.get(var, TOP))
+            if new != state[s] or state[s] is None:
+                state[s] = new
+                if s not in queued:
+                    queued.add(s)
+                    work.append(s)
+    return state
+
+
+def sccp(cfg: CFG) -> Counter:
+    """
+    Fold instructions whose results are constant into `const`, turn branches
+    on constant conditions into jumps and drop blocks that can never run.
+    """
+    stats = Counter()
+    by_label = {b.label: b.index for b in cfg.blocks if b.label is not None}
+    state = propagate(cfg)
+
+    kept = []
+    for block in cfg.blocks:
+        if state[block.index] is None:
+            stats["unreachable blocks"] += 1
+            continue
+        env = dict(state[block.index])
+        for k, instr in enumerate(block.instrs):
+            if "dest" in instr:
+                val = evaluate(instr, env)
+                env[instr["dest"]] = val
+                if instr["op"] in FOLDABLE and val is not TOP and val is not BOTTOM:
+                    block.instrs[k] = {
+                        "dest": instr["dest"],
+                        "op": "const",
+                        "type": instr["type"],
+                        "value": val,
+                    }
+                    stats["folded"] += 1
+            elif instr.get("op") == "br":
+                targets = branch_targets(block, env, by_label)
+                if len(targets) == 1 and len(block.succs) > 1:
+                    label = cfg.blocks[targets[0]].label
+                    block.instrs[k] = {"op": "jmp", "labels": [label]}
+                    stats["branches pruned"] += 1
+        kept.append(block)
+
+    for i, block in enumerate(kept):
+        block.index = i
+    cfg.blocks = kept
+    cfg.link()
+    return stats
+
+
+def constant_vars(cfg: CFG) -> dict:
+    """Variables whose every definition is the same `const`."""
+    values = {}
+    varying = {arg["name"] for arg in cfg.args}
+    for instr in cfg.instructions():
+        if "dest" not in instr:
+            continue
+        dest = instr["dest"]
+        if instr["op"] != "const" or dest in varying:
+            varying.add(dest)
+            continue
+        val = instr["value"]
+        if dest in values and (
+            type(values[dest]) is not type(val) or values[dest] != val
+        ):
+            varying.add(dest)
+            continue
+        values[dest] = val
+    return {var: val for var, val in values.items() if var not in varying}
@@ -0,0 +1,122 @@
+"""
+Keep the compiler resident and answer compile requests, so repeated
+compiles don't pay for interpreter startup and imports. Requests and
+replies are JSON objects, one per line:
+
+    {"args": [command line], "cwd": dir, "source": program}
+    -> {"status": exit status, "stdout": assembly, "stderr": diagnostics}
+
+"cwd" and "source" are optional. Without "source", a program the command
+line doesn't name is asked for with {"stdin": true}, answered by
+{"source": program}; over a plain stream it is an error instead.
+"""
+
+import contextlib
+import io
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+
+
+def default_socket() -> str:
+    """Where the server listens and the client connects unless told otherwise."""
+    if "BRIL2X86_SOCKET" in os.environ:
+        return os.environ["BRIL2X86_SOCKET"]
+    tmp = os.environ.get("TMPDIR", "/tmp")
+    return os.path.join(tmp, f"bril2x86-{os.getuid()}.sock")
+
+
+def handle(request: dict, compile, ask) -> dict:
+    """
+    Run `compile(args, read_stdin)` as the command line would, capturing
+    what it prints. `ask` fetches a program for stdin or returns None.
+    """
+
+    def read_stdin():
+        if "source" in request:
+            return request["source"]
+        source = ask()
+        if source is None:
+            raise SystemExit("no program given")
+        return source
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    status = 0
+    cwd = os.getcwd()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            os.chdir(request.get("cwd", cwd))
+            compile(request.get("args", []), read_stdin)
+        except SystemExit as e:
+            # argparse errors and --help
+            if isinstance(e.code, str):
+                print(e.code, file=stderr)
+                status = 1
+            else:
+                status = e.code or 0
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os.chdir(cwd)
+    return {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+def serve_stream(compile, inp, out, ask_for_stdin=False):
+    """
+    Answer one request per line of `inp` until it ends. With
+    `ask_for_stdin`, a missing program is requested from the other side.
+    """
+
+    def ask():
+        if not ask_for_stdin:
+            return None
+        out.write(json.dumps({"stdin": True}) + "\n")
+        out.flush()
+        line = inp.readline()
+        return json.loads(line)["source"] if line else None
+
+    for line in inp:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            reply = {"status": 1, "stdout": "", "stderr": f"bad request: {e}\n"}
+        else:
+            reply = handle(request, compile, ask)
+        out.write(json.dumps(reply) + "\n")
+        out.flush()
+
+
+def serve_socket(compile, path: str):
+    """Answer requests on a Unix domain socket at `path`, one at a time."""
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except OSError:
+                # left behind by a server that died
+                os.unlink(path)
+            else:
+                raise SystemExit(f"a compile server is already listening on {path}")
+
+    # unwind on kill too, so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(path)
+        server.listen()
+        try:
+            while True:
+                conn, _ = server.accept()
+                with conn, conn.makefile("r") as inp, conn.makefile("w") as out:
+                    try:
+                        serve_stream(compile, inp, out, ask_for_stdin=True)
+                    except OSError:
+                        # the client went away
+                        pass
+        finally:
+            os.unlink(path)
@@ -0,0 +1,469 @@
+from collections import Counter
+
+from cfg import CFG, BasicBlock, liveness
+from ifconvert import if_convert
+from layout import place_blocks, reachable
+from loops import insert_preheaders, licm, strength_reduce_ivs
+from passes import PassManager
+from unroll import unroll
+
+# phi argument for a predecessor on which the variable was never assigned
+UNDEFINED = "__undefined"
+
+PURE = {"const", "id", "add", "sub", "mul", "div", "eq", "lt", "gt", "le", "ge"}
+PURE |= {"not", "and", "or", "phi", "select", "ptradd"}
+# SSE arithmetic doesn't trap, even dividing by zero
+PURE |= {"fadd", "fsub", "fmul", "fdiv", "feq", "flt", "fgt", "fle", "fge"}
+COMMUTATIVE = {"add", "mul", "eq", "and", "or", "fadd", "fmul", "feq"}
+
+
+class Names:
+    """
+    Hands out variable and label names that don't clash with any in use.
+    Labels are also kept apart after the dots in them are mangled for
+    assembly.
+    """
+
+    def __init__(self, cfg: CFG):
+        self.taken = {arg["name"] for arg in cfg.args}
+        for block in cfg.blocks:
+            if block.label is not None:
+                self.taken.add(block.label)
+                self.taken.add(block.label.replace(".", "_"))
+            for instr in block.instrs:
+                self.taken.update(instr.get("args", []))
+                if "dest" in instr:
+                    self.taken.add(instr["dest"])
+        self.counter = Counter()
+
+    def fresh(self, base: str, label=False) -> str:
+        while True:
+            self.counter[base] += 1
+            name = f"{base}.{self.counter[base]}"
+            mangled = name.replace(".", "_")
+            if name not in self.taken and not (label and mangled in self.taken):
+                self.taken.add(name)
+                if label:
+                    self.taken.add(mangled)
+                return name
+
+
+def dominance_frontiers(cfg: CFG, idom) -> list[set[int]]:
+    frontiers = [set() for _ in cfg.blocks]
+    for block in cfg.blocks:
+        if len(block.preds) < 2:
+            continue
+        for p in block.preds:
+            runner = p
+            while runner != idom[block.index]:
+                frontiers[runner].add(block.index)
+                runner = idom[runner]
+    return frontiers
+
+
+def prepare(cfg: CFG, names: Names):
+    """
+    Drop unreachable blocks, give the function an entry block nothing jumps
+    to and label every block so phis can name their predecessors.
+    """
+    live = reachable(cfg)
+    place_blocks(cfg, [b for b in range(len(cfg.blocks)) if live[b]])
+    if cfg.blocks[0].preds:
+        cfg.blocks.insert(0, BasicBlock(0, None, []))
+        place_blocks(cfg, range(len(cfg.blocks)))
+    for block in cfg.blocks:
+        if block.label is None:
+            block.label = names.fresh(
+                "entry" if block.index == 0 else "block", label=True
+            )
+
+
+def to_ssa(cfg: CFG, names: Names):
+    """
+    Pruned SSA: a phi for a variable goes on the iterated dominance
+    frontier of its definitions, where the variable is live on entry. Every
+    definition then gets a fresh name; arguments keep theirs.
+    """
+    prepare(cfg, names)
+    idom = cfg.dominators()
+    frontiers = dominance_frontiers(cfg, idom)
+    live_in, _ = liveness(cfg)
+
+    types = {arg["name"]: arg["type"] for arg in cfg.args}
+    def_blocks = {}
+    for block in cfg.blocks:
+        for instr in block.instrs:
+            if "dest" in instr:
+                types[instr["dest"]] = instr["type"]
+                def_blocks.setdefault(instr["dest"], set()).add(block.index)
+
+    phis = [[] for _ in cfg.blocks]
+    # phi -> the variable it merges, as its dest gets renamed
+    phi_var = {}
+    for var, blocks in def_blocks.items():
+        work = list(blocks)
+        placed = set()
+        while work:
+            for f in frontiers[work.pop()]:
+                if f in placed or var not in live_in[f]:
+                    continue
+                placed.add(f)
+                phi = {"dest": var, "op": "phi", "type": types[var]}
+                phi.update(args=[], labels=[])
+                phi_var[id(phi)] = var
+                phis[f].append(phi)
+                if f not in blocks:
+                    work.append(f)
+
+    for block in cfg.blocks:
+        block.instrs[:0] = phis[block.index]
+
+    stacks = {arg["name"]: [arg["name"]] for arg in cfg.args}
+    children = cfg.dominator_tree(idom)
+
+    def rename_block(block: BasicBlock, pushed: list):
+        for instr in block.instrs:
+            if instr["op"] != "phi" and "args" in instr:
+                instr["args"] = [
+                    stacks[a][-1] if stacks.get(a) else a for a in instr["args"]
+                ]
+            if "dest" in instr:
+                var = instr["dest"]
+                instr["dest"] = names.fresh(var)
+                stacks.setdefault(var, []).append(instr["dest"])
+                pushed.append(var)
+        for s in block.succs:
+            for phi in cfg.blocks[s].instrs:
+                if phi["op"] != "phi":
+                    break
+                stack = stacks.get(phi_var[id(phi)])
+                phi["args"].append(stack[-1] if stack else UNDEFINED)
+                phi["labels"].append(block.label)
+
+    # iterative walk of the dominator tree, popping names on the way out
+    work = [(0, False)]
+    scopes = []
+    while work:
+        b, leaving = work.pop()
+        if leaving:
+            for var in scopes.pop():
+                stacks[var].pop()
+            continue
+        pushed = []
+        rename_block(cfg.blocks[b], pushed)
+        scopes.append(pushed)
+        work.append((b, True))
+        work.extend((c, False) for c in reversed(children[b]))
+
+
+def substitute(cfg: CFG, replace: dict):
+    """Rewrite every use through `replace`, following chains."""
+
+    def find(var):
+        while var in replace:
+            var = replace[var]
+        return var
+
+    for instr in cfg.instructions():
+        if "args" in instr:
+            instr["args"] = [find(a) for a in instr["args"]]
+
+
+def value_key(instr, number):
+    op = instr["op"]
+    # pointer types are dicts
+    typ = repr(instr["type"])
+    if op == "const":
+        return ("const", typ, instr["value"])
+    args = [number(a) for a in instr.get("args", [])]
+    if op in COMMUTATIVE:
+        args.sort()
+    return (op, typ, *args)
+
+
+def gvn(cfg: CFG) -> int:
+    """
+    Dominator-based value numbering: an instruction computing the same
+    value as one in a dominating block is removed and its uses renamed.
+    Copies and phis whose arguments all agree are removed the same way.
+    Returns how many instructions went away.
+    """
+    replace = {}
+
+    def number(var):
+        while var in replace:
+            var = replace[var]
+        return var
+
+    idom = cfg.dominators()
+    children = cfg.dominator_tree(idom)
+    table = {}
+    removed = 0
+    work = [(0, None)]
+    while work:
+        b, undo = work.pop()
+        if undo is not None:
+            for key in undo:
+                del table[key]
+            continue
+        block = cfg.blocks[b]
+        added = []
+        kept = []
+        for instr in block.instrs:
+            op = instr.get("op")
+            if "dest" not in instr or op not in PURE:
+                kept.append(instr)
+                continue
+            dest = instr["dest"]
+            if op == "id" and instr["args"][0] != UNDEFINED:
+                replace[dest] = number(instr["args"][0])
+                removed += 1
+                continue
+            if op == "phi":
+                args = {number(a) for a in instr["args"]} - {dest}
+                if len(args) == 1 and UNDEFINED not in args:
+                    replace[dest] = args.pop()
+                    removed += 1
+                    continue
+                kept.append(instr)
+                continue
+            key = value_key(instr, number)
+            if key in table:
+                replace[dest] = table[key]
+                removed += 1
+                continue
+            table[key] = dest
+            added.append(key)
+            kept.append(instr)
+        block.instrs = kept
+        work.append((b, added))
+        work.extend((c, None) for c in reversed(children[b]))
+
+    substitute(cfg, replace)
+    return removed
+
+
+def dce(cfg: CFG) -> int:
+    """
+    Mark-and-sweep dead code elimination: everything with an effect is
+    live, as is whatever a live instruction reads; the rest is removed.
+    Unlike deleting unused definitions one at a time, this also removes
+    dead cycles through phis. Returns how many instructions went away.
+    """
+    defs = {}
+    consts = {}
+    for instr in cfg.instructions():
+        if "dest" in instr:
+            defs[instr["dest"]] = instr
+            if instr["op"] == "const":
+                consts[instr["dest"]] = instr["value"]
+
+    def has_effect(instr):
+        op = instr["op"]
+        if op == "div":
+            # dividing by zero is an error we must not hide
+            return consts.get(instr["args"][1], 0) == 0
+        return op not in PURE
+
+    live = set()
+    work = []
+    for instr in cfg.instructions():
+        if has_effect(instr):
+            live.add(id(instr))
+            work.append(instr)
+    while work:
+        for a in work.pop().get("args", []):
+            d = defs.get(a)
+            if d is not None and id(d) not in live:
+                live.add(id(d))
+                work.append(d)
+
+    removed = 0
+    for block in cfg.blocks:
+        kept = [instr for instr in block.instrs if id(instr) in live]
+        removed += len(block.instrs) - len(kept)
+        block.instrs = kept
+    return removed
+
+
+def split_critical_edges(cfg: CFG, names: Names):
+    """
+    Put a block on every edge into a phi block from a block that branches.
+    The new blocks go right after the branch, which never falls through, so
+    no other block's fall-through changes.
+    """
+    by_label = {b.label: b for b in cfg.blocks}
+    blocks = []
+    for block in cfg.blocks:
+        blocks.append(block)
+        if len(block.succs) < 2:
+            continue
+        term = block.terminator()
+        for i, label in enumerate(term["labels"]):
+            target = by_label[label]
+            if not target.instrs or target.instrs[0]["op"] != "phi":
+                continue
+            middle = BasicBlock(
+                0, names.fresh(label, label=True), [{"op": "jmp", "labels": [label]}]
+            )
+            blocks.append(middle)
+            term["labels"][i] = middle.label
+            for phi in target.instrs:
+                if phi["op"] != "phi":
+                    break
+                phi["labels"] = [
+                    middle.label if l == block.label else l for l in phi["labels"]
+                ]
+    cfg.blocks = blocks
+    place_blocks(cfg, range(len(blocks)))
+
+
+def interference(cfg: CFG, candidates: set[str]):
+    """
+    For each of the `candidates`, the other candidates live where it is
+    defined; two names interfere if either is in the other's set.
+    """
+    edges = {var: set() for var in candidates}
+    _, live_out = liveness(cfg)
+    for block in cfg.blocks:
+        live = set(live_out[block.index])
+        for instr in reversed(block.instrs):
+            dest = instr.get("dest")
+            if dest is not None:
+                live.discard(dest)
+                # a copy doesn't make its source and destination interfere
+                if instr["op"] == "id":
+                    others = live - {instr["args"][0]}
+                else:
+                    others = live
+                if dest in candidates:
+                    edges[dest].update(others & candidates)
+            live.update(instr.get("args", []))
+        if block.index == 0:
+            # parameters are all defined on entry, before any instruction
+            for arg in cfg.args:
+                if arg["name"] in candidates:
+                    edges[arg["name"]].update((live - {arg["name"]}) & candidates)
+    return edges
+
+
+def out_of_ssa(cfg: CFG, names: Names) -> int:
+    """
+    Replace phis with copies and coalesce the copies away where the names
+    don't interfere. Each phi first gets its own temporary, copied into in
+    every predecessor and out of at the top of its block, which keeps
+    parallel-copy problems (swaps, lost copies) out of the picture.
+    Returns the number of copies left.
+    """
+    split_critical_edges(cfg, names)
+    by_label = {b.label: b for b in cfg.blocks}
+
+    for block in cfg.blocks:
+        copies = []
+        for phi in block.instrs:
+            if phi["op"] != "phi":
+                break
+            temp = names.fresh(phi["dest"])
+            for arg, label in zip(phi["args"], phi["labels"]):
+                if arg == UNDEFINED:
+                    continue
+                pred = by_label[label]
+                copy = {"dest": temp, "op": "id", "type": phi["type"], "args": [arg]}
+                if pred.terminator() is not None:
+                    pred.instrs.insert(len(pred.instrs) - 1, copy)
+                else:
+                    pred.instrs.append(copy)
+            copies.append(
+                {"dest": phi["dest"], "op": "id", "type": phi["type"], "args": [temp]}
+            )
+        block.instrs[: len(copies)] = copies
+
+    # constants stay apart so they can still be used as immediates
+    consts = {i["dest"] for i in cfg.instructions() if i.get("op") == "const"}
+    pairs = [
+        (i["dest"], i["args"][0])
+        for i in cfg.instructions()
+        if i.get("op") == "id"
+        and i["dest"] not in consts
+        and i["args"][0] not in consts
+    ]
+    candidates = {v for pair in pairs for v in pair}
+    edges = interference(cfg, candidates)
+
+    leader = {}
+    members = {var: [var] for var in candidates}
+
+    def find(var):
+        while var in leader:
+            var = leader[var]
+        return var
+
+    def interfere(a, b):
+        return any(m in edges[a] for m in members[b]) or any(
+            m in edges[b] for m in members[a]
+        )
+
+    # parameters keep their names, since the arguments arrive under them, so
+    # one always leads its class and two never merge
+    params = {arg["name"] for arg in cfg.args}
+    for a, b in pairs:
+        a, b = find(a), find(b)
+        if a == b or interfere(a, b) or (a in params and b in params):
+            continue
+        # otherwise keep the shorter, usually original, name
+        if b in params or (a not in params and len(b) < len(a)):
+            a, b = b, a
+        leader[b] = a
+        edges[a] |= edges.pop(b)
+        members[a] += members.pop(b)
+
+    left = 0
+    for block in cfg.blocks:
+        kept = []
+        for instr in block.instrs:
+            if "dest" in instr:
+                instr["dest"] = find(instr["dest"])
+            if "args" in instr:
+                instr["args"] = [find(a) for a in instr["args"]]
+            if instr.get("op") == "id" and instr["args"][0] == instr["dest"]:
+                continue
+            left += instr.get("op") == "id"
+            kept.append(instr)
+        block.instrs = kept
+    return left
+
+
+def optimize_loops(cfg: CFG, names: Names, unroll_factor: int, unroll_budget: int):
+    stats = Counter()
+    insert_preheaders(cfg, names)
+    stats["hoisted"] = licm(cfg)
+    stats["ivs"] = strength_reduce_ivs(cfg, names)
+    stats["unrolled"] = unroll(cfg, names, unroll_factor, unroll_budget)
+    return stats
+
+
+def optimize(
+    cfg: CFG,
+    pm: PassManager = PassManager(),
+    loop_opts=True,
+    unroll_factor=4,
+    unroll_budget=256,
+    if_conversion=True,
+) -> Counter:
+    """
+    Run SSA construction, GVN, if-conversion, loop optimisations, DCE and
+    SSA destruction on `cfg`, each as a pass of `pm`.
+    """
+    stats = Counter()
+    names = Names(cfg)
+    pm.run("ssa", to_ssa, cfg, names)
+    stats["gvn"] = pm.run("gvn", gvn, cfg)
+    if if_conversion:
+        stats["if-converted"] = pm.run("if-conversion", if_convert, cfg)
+    if loop_opts:
+        stats.update(
+            pm.run("loops", optimize_loops, cfg, names, unroll_factor, unroll_budget)
+        )
+    stats["dce"] = pm.run("dce", dce, cfg)
+    stats["copies"] = pm.run("out-of-ssa", out_of_ssa, cfg, names)
+    return stats
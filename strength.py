@@ -0,0 +1,138 @@
+from regalloc import is_reg
+from sccp import wrap
+from x86 import (
+    ADD,
+    MUL,
+    NEG,
+    SAR,
+    SHL,
+    SHR,
+    SUB,
+    Binary,
+    Instruction,
+    Lea,
+    Mov,
+    Unary,
+    immediate,
+    memory,
+)
+
+# multipliers a single lea can apply: x * (1 + scale)
+LEA_FACTORS = {3: 2, 5: 4, 9: 8}
+
+
+def log2(val: int):
+    """k if `val` is 2**k with k >= 1, else None."""
+    if val > 1 and val & (val - 1) == 0:
+        return val.bit_length() - 1
+    return None
+
+
+def load(src: str, dest: str) -> list[Instruction]:
+    return [] if src == dest else [Mov("q", src, dest)]
+
+
+def mul_by_constant(src: str, c: int, dest: str):
+    """
+    Instructions computing dest = src * c with shifts and lea, or None if
+    imulq is the better choice. `src` is a register or memory operand.
+    """
+    work = dest if is_reg(dest) else "%rax"
+    c = wrap(c)
+    negate = c < 0 and c != -(2**63)
+    m = -c if negate else c & (2**64 - 1)
+
+    if m == 0:
+        return [Mov("q", "$0", dest)]
+    if m == 1:
+        lines = load(src, work)
+    elif (k := log2(m)) is not None:
+        lines = load(src, work) + [Binary(SHL, immediate(k), work)]
+    else:
+        for factor, scale in LEA_FACTORS.items():
+            k = log2(m // factor) if m % factor == 0 else None
+            if m == factor or k is not None:
+                break
+        else:
+            return None
+        base = src if is_reg(src) else work
+        lines = load(src, base)
+        lines.append(Lea(memory(base, base, scale), work))
+        if k is not None:
+            lines.append(Binary(SHL, immediate(k), work))
+
+    if negate:
+        lines.append(Unary(NEG, work))
+    return lines + load(work, dest)
+
+
+def magic(d: int) -> tuple[int, int]:
+    """
+    Signed 64-bit magic multiplier and shift for dividing by `d`, for
+    |d| >= 2 (Hacker's Delight, 10-1).
+    """
+    two63 = 2**63
+    ad = abs(d)
+    t = two63 + (1 if d < 0 else 0)
+    anc = t - 1 - t % ad
+    p = 63
+    q1, r1 = divmod(two63, anc)
+    q2, r2 = divmod(two63, ad)
+    while True:
+        p += 1
+        q1, r1 = 2 * q1, 2 * r1
+        if r1 >= anc:
+            q1, r1 = q1 + 1, r1 - anc
+        q2, r2 = 2 * q2, 2 * r2
+        if r2 >= ad:
+            q2, r2 = q2 + 1, r2 - ad
+        delta = ad - r2
+        if not (q1 < delta or (q1 == delta and r1 == 0)):
+            break
+    m = q2 + 1
+    return wrap(-m if d < 0 else m), p - 64
+
+
+def div_by_constant(src: str, d: int) -> list[Instruction]:
+    """
+    Instructions leaving src / d, truncated toward zero, in %rax. `src` is a
+    register or memory operand other than %rax and %rdx, and d is non-zero.
+    """
+    d = wrap(d)
+    assert d != 0
+    if d in (1, -1):
+        lines = [Mov("q", src, "%rax")]
+        if d == -1:
+            lines.append(Unary(NEG, "%rax"))
+        return lines
+
+    k = log2(abs(d))
+    if k is not None:
+        # bias negative dividends by 2**k - 1 so the shift rounds toward zero
+        lines = [Mov("q", src, "%rax"), Mov("q", "%rax", "%rdx")]
+        if k > 1:
+            lines.append(Binary(SAR, "$63", "%rdx"))
+        lines += [
+            Binary(SHR, immediate(64 - k), "%rdx"),
+            Binary(ADD, "%rdx", "%rax"),
+            Binary(SAR, immediate(k), "%rax"),
+        ]
+        if d < 0:
+            lines.append(Unary(NEG, "%rax"))
+        return lines
+
+    m, shift = magic(d)
+    lines = [Mov("absq", immediate(m), "%rax"), Unary(MUL, src)]
+    if d > 0 and m < 0:
+        lines.append(Binary(ADD, src, "%rdx"))
+    elif d < 0 and m > 0:
+        lines.append(Binary(SUB, src, "%rdx"))
+    if shift:
+        lines.append(Binary(SAR, immediate(shift), "%rdx"))
+    # add one if the quotient is negative
+    lines += [
+        Mov("q", "%rdx", "%rax"),
+        Binary(SHR, "$63", "%rax"),
+        Binary(ADD, "%rdx", "%rax"),
+    ]
+    return lines
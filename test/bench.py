@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Time compiled Bril programs at several optimization levels, and brili, and
+compare the numbers with an earlier run.
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from test import ROOT, build_runtime, extract_args, normalize_whitespace
+
+import bril2x86
+from server import handle
+
+# flags for each level; O2 is what the compiler does by default
+levels = {
+    "O0": [
+        "--no-regalloc",
+        "--inline-threshold=0",
+        "--no-sccp",
+        "--no-ssa",
+        "--no-layout",
+        "--no-tail-calls",
+        "--no-strength-reduction",
+        "--no-slot-sharing",
+        "--no-peephole",
+    ],
+    "O1": ["--inline-threshold=0", "--no-ssa"],
+    "O2": [],
+}
+
+FRAME = re.compile(r"^(\S+): frame \d+ -> (\d+) bytes$")
+
+
+def find_programs(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += glob.glob(os.path.join(path, "**", "*.bril"), recursive=True)
+        elif os.path.isfile(path):
+            files.append(path)
+    return sorted(set(os.path.abspath(f) for f in files))
+
+
+def compile_program(bril_file, flags, out_dir, rt_o):
+    """
+    Build `bril_file` with `flags` into out_dir/prog. Returns the executable,
+    the number of instructions emitted and each function's frame size, or
+    raises RuntimeError.
+    """
+    reply = handle(
+        {"args": [bril_file, "--report-frames"] + flags}, bril2x86.main, lambda: None
+    )
+    if reply["status"] != 0:
+        raise RuntimeError(f"[bril2x86.py failed] {reply['stderr']}")
+    asm = reply["stdout"]
+    code_size = sum(
+        1
+        for line in asm.splitlines()
+        if line and not line.startswith(".") and not line.endswith(":")
+    )
+    frames = {}
+    for line in reply["stderr"].splitlines():
+        m = FRAME.match(line)
+        if m:
+            frames[m[1]] = int(m[2])
+
+    asm_path = os.path.join(out_dir, "prog.s")
+    exec_path = os.path.join(out_dir, "prog")
+    with open(asm_path, "w") as f:
+        f.write(asm)
+    gcc = subprocess.run(
+        ["gcc", asm_path, rt_o, "-o", exec_path], capture_output=True, text=True
+    )
+    if gcc.returncode != 0:
+        raise RuntimeError(f"[gcc failed] {gcc.stderr}")
+    return exec_path, code_size, frames
+
+
+def time_runs(cmd, stdin, runs, warmup, timeout):
+    """
+    Wall times in seconds of `runs` runs of `cmd`, after `warmup` unmeasured
+    ones, and what the last run printed.
+    """
+    times = []
+    for i in range(warmup + runs):
+        start = time.perf_counter()
+        p = subprocess.run(
+            cmd, input=stdin, capture_output=True, text=True, timeout=timeout
+        )
+        elapsed = time.perf_counter() - start
+        if p.returncode != 0:
+            raise RuntimeError(f"[exit {p.returncode}] {p.stderr}")
+        if i >= warmup:
+            times.append(elapsed)
+    return times, p.stdout
+
+
+def perf_counters(cmd, timeout):
+    """Instructions retired and cycles for one run of `cmd`, or None each."""
+    counters = {"instructions": None, "cycles": None}
+    if shutil.which("perf") is None:
+        return counters
+    with tempfile.NamedTemporaryFile("r", suffix=".csv") as out:
+        p = subprocess.run(
+            ["perf", "stat", "-x", ",", "-e", "instructions,cycles", "-o", out.name]
+            + ["--"]
+            + cmd,
+            capture_output=True,
+            timeout=timeout,
+        )
+        if p.returncode != 0:
+            return counters
+        for line in out:
+            fields = line.strip().split(",")
+            if len(fields) < 3:
+                continue
+            # the event name may carry a suffix such as instructions:u
+            event = fields[2].split(":")[0]
+            if event in counters and fields[0].isdigit():
+                counters[event] = int(fields[0])
+    return counters
+
+
+def timing(times):
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "runs": times,
+    }
+
+
+def bench_brili(bril_file, args, opts):
+    with open(bril_file) as f:
+        source = f.read()
+    prog = subprocess.run(
+        ["bril2json"], input=source, capture_output=True, text=True, check=True
+    ).stdout
+    # -p reports the dynamic instruction count on stderr
+    p = subprocess.run(
+        ["brili", "-p"] + args,
+        input=prog,
+        capture_output=True,
+        text=True,
+        timeout=opts.timeout,
+    )
+    m = re.search(r"total_dyn_inst: (\d+)", p.stderr)
+    times, output = time_runs(
+        ["brili"] + args, prog, opts.runs, opts.warmup, opts.timeout
+    )
+    return {
+        "time": timing(times),
+        "dyn_inst": int(m[1]) if m else None,
+        "output": output,
+    }
+
+
+def bench_level(bril_file, args, flags, rt_o, opts):
+    with tempfile.TemporaryDirectory(prefix="bril_bench_") as tmp:
+        exe, code_size, frames = compile_program(bril_file, flags, tmp, rt_o)
+        cmd = [exe] + args
+        times, output = time_runs(cmd, None, opts.runs, opts.warmup, opts.timeout)
+        result = {
+            "time": timing(times),
+            "output": output,
+            **perf_counters(cmd, opts.timeout),
+        }
+    result.update(code_size=code_size, frames=frames, frame_total=sum(frames.values()))
+    return result
+
+
+def run_benchmarks(files, opts, rt_o):
+    results = {}
+    for f in files:
+        name = os.path.relpath(f, ROOT)
+        args = extract_args(f)
+        results[name] = {}
+        # every build must print what the first one to run did, brili or
+        # else O0, so a miscompiled build can't count as faster
+        builds = [l for l in levels if l in opts.levels]
+        if opts.brili:
+            builds.insert(0, "brili")
+        reference = None
+        for build in builds:
+            try:
+                if build == "brili":
+                    r = bench_brili(f, args, opts)
+                else:
+                    r = bench_level(f, args, levels[build], rt_o, opts)
+                output = normalize_whitespace(r.pop("output"))
+                if reference is None:
+                    reference = (build, output)
+                elif output != reference[1]:
+                    raise RuntimeError(f"[wrong output] differs from {reference[0]}'s")
+                summary = f"{r['time']['median'] * 1000:.2f} ms"
+            except (RuntimeError, subprocess.SubprocessError, OSError) as e:
+                r = {"error": str(e).strip()}
+                summary = "FAILED"
+            results[name][build] = r
+            print(f"{name} {build}: {summary}", flush=True)
+    return results
+
+
+def change(old, new):
+    return (new - old) / old if old else 0
+
+
+def metrics(r, opts):
+    """(name, value, tolerance) for each number compared between runs."""
+    return [
+        ("fastest time", r["time"]["min"], opts.time_tolerance),
+        ("instructions", r.get("instructions"), opts.count_tolerance),
+        ("dynamic instructions", r.get("dyn_inst"), opts.count_tolerance),
+        ("cycles", r.get("cycles"), opts.time_tolerance),
+        ("code size", r.get("code_size"), 0),
+        ("frame bytes", r.get("frame_total"), 0),
+    ]
+
+
+def compare(results, baseline, opts):
+    """
+    Print what got slower or bigger since `baseline`, and what got faster.
+    Returns the number of regressions.
+    """
+    regressions = 0
+    for name, builds in sorted(results.items()):
+        for build, new in builds.items():
+            old = baseline.get(name, {}).get(build)
+            if old is None or "error" in old:
+                continue
+            if "error" in new:
+                print(f"REGRESSION {name} {build}: {new['error']}")
+                regressions += 1
+                continue
+            for (what, a, tolerance), (_, b, _) in zip(
+                metrics(old, opts), metrics(new, opts)
+            ):
+                if a is None or b is None:
+                    continue
+                delta = change(a, b)
+                if delta > tolerance:
+                    print(
+                        f"REGRESSION {name} {build}: {what} {a:g} -> {b:g} ({delta:+.1%})"
+                    )
+                    regressions += 1
+                elif delta < -tolerance:
+                    print(
+                        f"improved {name} {build}: {what} {a:g} -> {b:g} ({delta:+.1%})"
+                    )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        default=[
+            os.path.join(ROOT, "bril/benchmarks"),
+            os.path.join(ROOT, "bril_programs"),
+        ],
+        help="programs, or directories searched for .bril files",
+    )
+    parser.add_argument(
+        "--levels",
+        type=lambda s: s.split(","),
+        default=list(levels),
+        help=f"comma-separated optimization levels to build (default: {','.join(levels)})",
+    )
+    parser.add_argument(
+        "--no-brili", dest="brili", action="store_false", help="don't time brili"
+    )
+    parser.add_argument(
+        "--runs", type=int, default=5, help="measured runs per build (default: 5)"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=1, help="unmeasured runs first (default: 1)"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="seconds a single run may take"
+    )
+    parser.add_argument(
+        "-o", "--output", default="bench_output.json", help="where to write the results"
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="BASELINE",
+        help="results of an earlier run to compare against",
+    )
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=0.05,
+        help="relative slowdown in time or cycles reported as a regression (default: 0.05)",
+    )
+    parser.add_argument(
+        "--count-tolerance",
+        type=float,
+        default=0.01,
+        help="relative growth in instructions retired reported as a regression (default: 0.01)",
+    )
+    opts = parser.parse_args()
+
+    unknown = [l for l in opts.levels if l not in levels]
+    if unknown:
+        parser.error(
+            f"unknown levels {', '.join(unknown)}; choose from {', '.join(levels)}"
+        )
+    if opts.brili and shutil.which("brili") is None:
+        print("brili not found, not timing it", file=sys.stderr)
+        opts.brili = False
+
+    files = find_programs(opts.paths)
+    if not files:
+        print("No .bril files found!", file=sys.stderr)
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory(prefix="bril_rt_") as rt_dir:
+        rt_o = build_runtime(os.path.join(ROOT, "rt.c"), rt_dir)
+        results = run_benchmarks(files, opts, rt_o)
+
+    with open(opts.output, "w") as f:
+        meta = {
+            "levels": {l: levels[l] for l in opts.levels},
+            "runs": opts.runs,
+            "warmup": opts.warmup,
+        }
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    print(f"\nwrote {opts.output}")
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, opts)
+        print(f"\n{regressions} regressions against {opts.compare}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
-import subprocess
+import argparse
+import concurrent.futures
 import glob
+import hashlib
+import json
 import os
+import signal
+import subprocess
 import sys
 import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+import bril2x86
+from server import handle
 
 
 def extract_args(bril_file):
@@ -29,78 +42,218 @@ def normalize_whitespace(s):
     return " ".join(s.split())
 
 
-def run_reference(bril_file, args):
+def reference_key(source, args):
+    """Cache key for brili's result on `source` run with `args`."""
+    h = hashlib.sha256(source.encode())
+    for arg in args:
+        h.update(b"\0" + arg.encode())
+    return h.hexdigest()
+
+
+def run_reference(bril_file, args, cache_dir, timeout):
+    """
+    brili's exit code, stdout and stderr, from the cache when it has them.
+    A code of None means the reference couldn't be run; stderr says why.
+    """
     with open(bril_file, "r") as f:
-        p1 = subprocess.Popen(
-            ["bril2json"],
-            stdin=f,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
+        source = f.read()
+    cached = None
+    if cache_dir is not None:
+        cached = os.path.join(cache_dir, reference_key(source, args) + ".json")
+        if os.path.exists(cached):
+            with open(cached) as f:
+                ref = json.load(f)
+            return ref["code"], ref["out"], ref["err"]
+
+    try:
+        p1 = subprocess.run(
+            ["bril2json"], input=source, capture_output=True, text=True, timeout=timeout
         )
-        p2 = subprocess.Popen(
+        if p1.returncode != 0:
+            return None, None, f"[bril2json failed] {p1.stderr}"
+        p2 = subprocess.run(
             ["brili"] + args,
-            stdin=p1.stdout,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            input=p1.stdout,
+            capture_output=True,
             text=True,
+            timeout=timeout,
         )
-        p1.stdout.close()
-        out, err = p2.communicate()
-    return p2.returncode, out, err
+    except subprocess.TimeoutExpired:
+        return None, None, f"[brili timed out after {timeout}s]"
+    except FileNotFoundError as e:
+        return None, None, f"[{e.filename} not found]"
 
+    if cached is not None:
+        # several workers may write the same entry; each write is atomic
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"code": p2.returncode, "out": p2.stdout, "err": p2.stderr}, f)
+        os.replace(tmp, cached)
+    return p2.returncode, p2.stdout, p2.stderr
 
-def run_compiled(bril_file, args, rt_c_path):
-    with open(bril_file, "r") as f:
-        p1 = subprocess.Popen(
-            ["bril2json"],
-            stdin=f,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-        p2 = subprocess.Popen(
-            ["python3", "bril2x86.py"],
-            stdin=p1.stdout,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-        p1.stdout.close()
-        asm, err_asm = p2.communicate()
-        if p2.returncode != 0:
-            return None, None, f"[bril2x86.py failed] {err_asm}"
 
-    fd, exec_path = tempfile.mkstemp(prefix="bril_exec_")
-    os.close(fd)
+def build_runtime(rt_c_path, out_dir):
+    """Compile rt.c once into an object every test links against."""
+    rt_o = os.path.join(out_dir, "rt.o")
     gcc = subprocess.run(
-        ["gcc", rt_c_path, "-x", "assembler", "-o", exec_path, "-"],
-        input=asm,
-        text=True,
-        capture_output=True,
+        ["gcc", "-O2", "-c", rt_c_path, "-o", rt_o], capture_output=True, text=True
     )
     if gcc.returncode != 0:
-        os.unlink(exec_path)
-        return None, None, f"[gcc failed] {gcc.stderr}"
+        print(f"Error: could not compile {rt_c_path}\n{gcc.stderr}", file=sys.stderr)
+        sys.exit(1)
+    return rt_o
+
+
+def compile_in_worker(bril_file, timeout):
+    """
+    The compiler's reply for `bril_file`, run in this process. An alarm
+    stops it after `timeout` seconds, since there's no process to kill.
+    """
+
+    def expire(signum, frame):
+        raise SystemExit(f"[timed out after {timeout}s]")
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return handle({"args": [bril_file]}, bril2x86.main, lambda: None)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
 
-    run = subprocess.run([exec_path] + args, capture_output=True, text=True)
-    out, code = run.stdout, run.returncode
 
-    os.unlink(exec_path)
-    return code, out, None
+def run_compiled(bril_file, args, rt_o, timeout):
+    # the compiler runs in this worker, so only gcc and the program are spawned
+    reply = compile_in_worker(bril_file, timeout)
+    if reply["status"] != 0:
+        return None, None, f"[bril2x86.py failed] {reply['stderr']}"
+
+    with tempfile.TemporaryDirectory(prefix="bril_exec_") as tmp:
+        asm_path = os.path.join(tmp, "prog.s")
+        exec_path = os.path.join(tmp, "prog")
+        with open(asm_path, "w") as f:
+            f.write(reply["stdout"])
+        try:
+            gcc = subprocess.run(
+                ["gcc", asm_path, rt_o, "-o", exec_path],
+                capture_output=True,
+                text=True,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return None, None, f"[gcc timed out after {timeout}s]"
+        if gcc.returncode != 0:
+            return None, None, f"[gcc failed] {gcc.stderr}"
+
+        try:
+            run = subprocess.run(
+                [exec_path] + args, capture_output=True, text=True, timeout=timeout
+            )
+        except subprocess.TimeoutExpired:
+            return None, None, f"[timed out after {timeout}s]"
+    return run.returncode, run.stdout, None
+
+
+def run_test(bril_file, rel, args, rt_o, cache_dir, timeout):
+    """
+    Compare one program against the reference. The result is a dict with the
+    file, its args, the status printed for it, and why it failed if it did.
+    """
+    start = time.perf_counter()
+    result = {"file": rel, "args": args}
+
+    ref_code, ref_out, ref_err = run_reference(bril_file, args, cache_dir, timeout)
+    if ref_code is None:
+        result.update(status="REF_FAIL", kind="reference", info=ref_err)
+    else:
+        cmp_code, cmp_out, cmp_err = run_compiled(bril_file, args, rt_o, timeout)
+        if cmp_err:
+            result.update(status="CMP_FAIL", kind="compiled", info=cmp_err)
+        # Compare codes and normalized outputs to ignore whitespace differences
+        elif ref_code != cmp_code or normalize_whitespace(
+            ref_out
+        ) != normalize_whitespace(cmp_out):
+            info = {
+                "ref_code": ref_code,
+                "cmp_code": cmp_code,
+                "ref_out": ref_out,
+                "cmp_out": cmp_out,
+            }
+            result.update(status="DIFF", kind="mismatch", info=info)
+        else:
+            result["status"] = "ok"
+    result["time"] = time.perf_counter() - start
+    return result
+
+
+def write_junit(results, elapsed, path):
+    failed = [r for r in results if r["status"] != "ok"]
+    suite = ET.Element(
+        "testsuite",
+        name="bril2x86",
+        tests=str(len(results)),
+        failures=str(len(failed)),
+        time=f"{elapsed:.3f}",
+    )
+    for r in results:
+        case = ET.SubElement(
+            suite,
+            "testcase",
+            classname=os.path.dirname(r["file"]) or ".",
+            name=os.path.basename(r["file"]),
+            time=f"{r['time']:.3f}",
+        )
+        if r["status"] != "ok":
+            failure = ET.SubElement(case, "failure", message=r["kind"])
+            info = r["info"]
+            failure.text = info if isinstance(info, str) else json.dumps(info)
+    ET.ElementTree(suite).write(path, encoding="unicode", xml_declaration=True)
 
 
 def main():
-    use_fallback = False
-    fallback_args = []
-    if len(sys.argv) > 1 and sys.argv[1] == "--fallback-args":
-        use_fallback = True
-        fallback_args = sys.argv[2:]
-
-    bril_root = os.path.abspath(
-        os.path.join(os.path.dirname(__file__), "../bril/benchmarks/core/")
+    parser = argparse.ArgumentParser(
+        description="Compare compiled Bril benchmarks against brili."
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of programs to test at once (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10,
+        help="seconds brili, the compiler, gcc or a compiled program may run (default: 10)",
     )
-    rt_c = os.path.join(os.path.dirname(__file__), "../rt.c")
+    parser.add_argument(
+        "--root",
+        default=os.path.join(ROOT, "bril/benchmarks/core/"),
+        help="directory searched for .bril files",
+    )
+    parser.add_argument(
+        "--cache",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"),
+        help="where brili's results are kept between runs",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help="always run brili",
+    )
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--junit", metavar="FILE", help="write a JUnit XML report")
+    parser.add_argument(
+        "--fallback-args",
+        nargs=argparse.REMAINDER,
+        help="run every program with these args instead of its ARGS line",
+    )
+    opts = parser.parse_args()
+
+    bril_root = os.path.abspath(opts.root)
+    rt_c = os.path.join(ROOT, "rt.c")
 
     if not os.path.isfile(rt_c):
         print(f"Error: could not find runtime C file at {rt_c}", file=sys.stderr)
@@ -112,48 +265,49 @@ def main():
         print("No .bril files found!", file=sys.stderr)
         sys.exit(1)
 
-    failures = []
-    for f in files:
-        rel = os.path.relpath(f, bril_root)
-        args = fallback_args if use_fallback else extract_args(f)
-
-        print(f"Testing {rel} with args: {args} ...", end=" ")
-        ref_code, ref_out, ref_err = run_reference(f, args)
-        if ref_code is None:
-            failures.append((rel, "reference", ref_err))
-            print("REF_FAIL")
-            continue
-
-        cmp_code, cmp_out, cmp_err = run_compiled(f, args, rt_c)
-        if cmp_err:
-            failures.append((rel, "compiled", cmp_err))
-            print("CMP_FAIL")
-            continue
+    cache_dir = opts.cache if opts.use_cache else None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
 
-        # Compare codes and normalized outputs to ignore whitespace differences
-        if ref_code != cmp_code or normalize_whitespace(
-            ref_out
-        ) != normalize_whitespace(cmp_out):
-            failures.append(
-                (
-                    rel,
-                    "mismatch",
-                    {
-                        "ref_code": ref_code,
-                        "cmp_code": cmp_code,
-                        "ref_out": ref_out,
-                        "cmp_out": cmp_out,
-                    },
+    start = time.perf_counter()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bril_rt_") as rt_dir:
+        rt_o = build_runtime(rt_c, rt_dir)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=opts.jobs) as pool:
+            futures = []
+            for f in files:
+                rel = os.path.relpath(f, bril_root)
+                args = opts.fallback_args
+                if args is None:
+                    args = extract_args(f)
+                futures.append(
+                    pool.submit(run_test, f, rel, args, rt_o, cache_dir, opts.timeout)
                 )
-            )
-            print("DIFF")
-        else:
-            print("ok")
+            for future in concurrent.futures.as_completed(futures):
+                r = future.result()
+                print(f"Testing {r['file']} with args: {r['args']} ... {r['status']}")
+                results.append(r)
+    elapsed = time.perf_counter() - start
+    results.sort(key=lambda r: r["file"])
+    failures = [r for r in results if r["status"] != "ok"]
+
+    if opts.json:
+        with open(opts.json, "w") as f:
+            summary = {
+                "passed": len(results) - len(failures),
+                "failed": len(failures),
+                "time": elapsed,
+                "results": results,
+            }
+            json.dump(summary, f, indent=2)
+    if opts.junit:
+        write_junit(results, elapsed, opts.junit)
 
     if failures:
         print("\n=== FAILURES ===")
-        for rel, kind, info in failures:
-            print(f"\nFile: {rel} — {kind}")
+        for r in failures:
+            print(f"\nFile: {r['file']} — {r['kind']}")
+            info = r["info"]
             if isinstance(info, str):
                 print(info)
             else:
@@ -162,9 +316,10 @@ def main():
                 print(info["ref_out"], end="")
                 print("  --- cmp stdout ---")
                 print(info["cmp_out"], end="")
+        print(f"\n{len(failures)} of {len(results)} failed in {elapsed:.1f}s")
         sys.exit(1)
     else:
-        print("\nAll tests passed!")
+        print(f"\nAll tests passed! ({len(results)} in {elapsed:.1f}s)")
         sys.exit(0)
 
 
@@ -0,0 +1,312 @@
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional
+
+from cfg import CFG, BasicBlock, Loop
+from layout import explicit_jumps, place_blocks
+from loops import basic_ivs, constants, loop_defs, phis, preheader
+from sccp import fold, wrap
+
+# loops running at most this many times are unrolled completely
+FULL_UNROLL_TRIPS = 16
+
+# i op n is the same test as n SWAPPED[op] i, and as not (i NEGATED[op] n)
+SWAPPED = {"lt": "gt", "gt": "lt", "le": "ge", "ge": "le"}
+NEGATED = {"lt": "ge", "ge": "lt", "gt": "le", "le": "gt"}
+
+
+@dataclass
+class CountedLoop:
+    """`while (iv op bound) body` where iv steps by a constant."""
+
+    iv: str
+    start: str
+    op: str
+    bound: str
+    step: int
+    body: str
+    exit: str
+    latch: str
+
+
+def use_counts(cfg: CFG) -> Counter:
+    return Counter(a for instr in cfg.instructions() for a in instr.get("args", []))
+
+
+def counted_loop(cfg: CFG, loop: Loop, consts, uses) -> Optional[CountedLoop]:
+    """
+    Match a loop whose header holds nothing but phis and the exit test, and
+    which can't be left from anywhere else.
+    """
+    header = cfg.blocks[loop.header]
+    if len(loop.latches) != 1 or len(header.instrs) != len(list(phis(header))) + 2:
+        return None
+    test, br = header.instrs[-2:]
+    if br["op"] != "br" or br["args"] != [test.get("dest")]:
+        return None
+    if test["op"] not in SWAPPED:
+        return None
+    if uses[test["dest"]] != 1:
+        return None
+    for b in loop.blocks - {loop.header}:
+        if any(s not in loop.blocks for s in cfg.blocks[b].succs):
+            return None
+
+    defs = loop_defs(cfg, loop)
+    ivs = basic_ivs(cfg, loop, defs)
+    (iv, bound), op = test["args"], test["op"]
+    if bound in ivs and iv not in defs:
+        iv, bound, op = bound, iv, SWAPPED[op]
+    if iv not in ivs or bound in defs:
+        return None
+
+    inside = {cfg.blocks[b].label for b in loop.blocks}
+    body, exit = br["labels"]
+    if body not in inside:
+        body, exit, op = exit, body, NEGATED[op]
+    if body not in inside or exit in inside or body == header.label:
+        return None
+
+    start, step, update, _ = ivs[iv]
+    if step not in consts:
+        return None
+    step = consts[step] if update == "add" else wrap(-consts[step])
+    if step == 0 or (op in ("lt", "le")) != (step > 0):
+        return None
+    latch = cfg.blocks[loop.latches[0]].label
+    return CountedLoop(iv, start, op, bound, step, body, exit, latch)
+
+
+def trip_count(counted: CountedLoop, start: int, bound: int, limit: int):
+    """How often the body runs, or None if more than `limit` times."""
+    for trips in range(limit + 1):
+        if not fold(counted.op, [start, bound]):
+            return trips
+        start = wrap(start + counted.step)
+    return None
+
+
+def clone(cfg: CFG, loop: Loop, names, values: dict) -> tuple[list, dict, dict]:
+    """
+    A copy of every loop block but the header, with fresh names and labels,
+    reading the header phis from `values`. Returns the blocks, the label
+    mapping, and what the header phis would be after the copy runs. Edges
+    to the header still point at its label.
+    """
+    header = cfg.blocks[loop.header]
+    body = [cfg.blocks[b] for b in sorted(loop.blocks - {loop.header})]
+    rename = dict(values)
+    labels = {}
+    for block in body:
+        labels[block.label] = names.fresh(block.label, label=True)
+        for instr in block.instrs:
+            if "dest" in instr:
+                rename[instr["dest"]] = names.fresh(instr["dest"])
+
+    blocks = []
+    for block in body:
+        instrs = []
+        for instr in block.instrs:
+            instr = dict(instr)
+            if "dest" in instr:
+                instr["dest"] = rename[instr["dest"]]
+            if "args" in instr:
+                instr["args"] = [rename.get(a, a) for a in instr["args"]]
+            if "labels" in instr:
+                instr["labels"] = [labels.get(l, l) for l in instr["labels"]]
+            instrs.append(instr)
+        blocks.append(BasicBlock(0, labels[block.label], instrs))
+
+    latch = cfg.blocks[loop.latches[0]].label
+    after = {}
+    for phi in phis(header):
+        (arg,) = [a for a, l in zip(phi["args"], phi["labels"]) if l == latch]
+        after[phi["dest"]] = rename.get(arg, arg)
+    return blocks, labels, after
+
+
+def chain(copies, header: str, counted: CountedLoop, first: str, last: str):
+    """
+    Link consecutive copies of a loop body: the one entered from `first`,
+    each from the previous one's latch, and the final one back to `last`.
+    """
+    for j, (blocks, labels, _) in enumerate(copies):
+        entered = first if j == 0 else copies[j - 1][1][counted.latch]
+        following = last if j == len(copies) - 1 else copies[j + 1][1][counted.body]
+        for block in blocks:
+            for instr in block.instrs:
+                if "labels" not in instr:
+                    continue
+                target = entered if instr["op"] == "phi" else following
+                instr["labels"] = [
+                    target if l == header else l for l in instr["labels"]
+                ]
+
+
+def retarget(block: BasicBlock, old: str, new: str):
+    term = block.terminator()
+    term["labels"] = [new if l == old else l for l in term["labels"]]
+
+
+def unroll_fully(cfg: CFG, loop: Loop, names, counted: CountedLoop, trips: int):
+    """
+    Replace the loop by `trips` copies of its body. The header stays behind
+    to pass the final values on; its test is known to fail.
+    """
+    header = cfg.blocks[loop.header]
+    pre = preheader(cfg, loop)
+    values = {}
+    for phi in phis(header):
+        (values[phi["dest"]],) = [
+            a for a, l in zip(phi["args"], phi["labels"]) if l == pre.label
+        ]
+
+    copies = []
+    for _ in range(trips):
+        copies.append(clone(cfg, loop, names, values))
+        values = copies[-1][2]
+    chain(copies, header.label, counted, pre.label, header.label)
+
+    retarget(pre, header.label, copies[0][1][counted.body])
+    last = copies[-1][1][counted.latch]
+    for phi in phis(header):
+        phi["args"], phi["labels"] = [values[phi["dest"]]], [last]
+    header.instrs[-1] = {"op": "jmp", "labels": [counted.exit]}
+
+    blocks = [b for b in cfg.blocks if b.index not in loop.blocks - {loop.header}]
+    at = blocks.index(header)
+    blocks[at:at] = [block for copy in copies for block in copy[0]]
+    cfg.blocks = blocks
+    place_blocks(cfg, range(len(blocks)))
+
+
+def unroll_partially(
+    cfg: CFG, loop: Loop, names, counted: CountedLoop, factor: int, consts
+) -> bool:
+    """
+    Put a loop running `factor` copies of the body per test in front of the
+    original, which is left to run the remaining iterations. The new loop
+    runs while iv + (factor - 1) * step still passes the test, i.e. while
+    iv passes it against bound - (factor - 1) * step; when that subtraction
+    would wrap, it is skipped. Returns False if it always would.
+    """
+    header = cfg.blocks[loop.header]
+    pre = preheader(cfg, loop)
+    distance = (factor - 1) * counted.step
+    if wrap(distance) != distance:
+        return False
+    # the shifted bound moves toward where the loop starts
+    moved = "lt" if counted.step > 0 else "gt"
+
+    limit = names.fresh(counted.bound)
+    ok = None
+    if counted.bound in consts:
+        value = wrap(consts[counted.bound] - distance)
+        if not fold(moved, [value, consts[counted.bound]]):
+            return False
+        setup = [{"dest": limit, "op": "const", "type": "int", "value": value}]
+    else:
+        amount = names.fresh("distance")
+        ok = names.fresh("unroll")
+        setup = [
+            {"dest": amount, "op": "const", "type": "int", "value": distance},
+            {
+                "dest": limit,
+                "op": "sub",
+                "type": "int",
+                "args": [counted.bound, amount],
+            },
+            {"dest": ok, "op": moved, "type": "bool", "args": [limit, counted.bound]},
+        ]
+
+    unrolled = BasicBlock(0, names.fresh(header.label, label=True), [])
+    values = {phi["dest"]: names.fresh(phi["dest"]) for phi in phis(header)}
+    copies = []
+    current = values
+    for _ in range(factor):
+        copies.append(clone(cfg, loop, names, current))
+        current = copies[-1][2]
+    chain(copies, header.label, counted, unrolled.label, unrolled.label)
+
+    last = copies[-1][1][counted.latch]
+    for phi in phis(header):
+        (start,) = [a for a, l in zip(phi["args"], phi["labels"]) if l == pre.label]
+        unrolled.instrs.append(
+            {
+                "dest": values[phi["dest"]],
+                "op": "phi",
+                "type": phi["type"],
+                "args": [start, current[phi["dest"]]],
+                "labels": [pre.label, last],
+            }
+        )
+        phi["args"].append(values[phi["dest"]])
+        phi["labels"].append(unrolled.label)
+    test = names.fresh("unroll")
+    unrolled.instrs += [
+        {
+            "dest": test,
+            "op": counted.op,
+            "type": "bool",
+            "args": [values[counted.iv], limit],
+        },
+        {
+            "op": "br",
+            "args": [test],
+            "labels": [copies[0][1][counted.body], header.label],
+        },
+    ]
+
+    if ok is None:
+        setup.append({"op": "jmp", "labels": [unrolled.label]})
+    else:
+        setup.append(
+            {"op": "br", "args": [ok], "labels": [unrolled.label, header.label]}
+        )
+    pre.instrs[-1:] = setup
+
+    at = loop.header
+    cfg.blocks[at:at] = [unrolled] + [block for copy in copies for block in copy[0]]
+    place_blocks(cfg, range(len(cfg.blocks)))
+    return True
+
+
+def unroll(cfg: CFG, names, factor: int, budget: int) -> int:
+    """
+    Unroll innermost counted loops: completely if they run a known number
+    of times up to FULL_UNROLL_TRIPS, otherwise `factor` times with the
+    original loop doing the remainder. At most `budget` instructions are
+    added to the function. Expects SSA with preheaders. Returns the number
+    of loops unrolled.
+    """
+    loops = cfg.loops()
+    headers = [cfg.blocks[l.header].label for l in loops if not l.children]
+    if not headers or budget <= 0:
+        return 0
+    explicit_jumps(cfg)
+
+    unrolled = 0
+    consts, uses = constants(cfg), use_counts(cfg)
+    for label in headers:
+        (loop,) = [l for l in loops if cfg.blocks[l.header].label == label]
+        counted = counted_loop(cfg, loop, consts, uses)
+        if counted is None:
+            continue
+        size = sum(len(cfg.blocks[b].instrs) for b in loop.blocks - {loop.header})
+
+        trips = None
+        if counted.start in consts and counted.bound in consts:
+            start, bound = consts[counted.start], consts[counted.bound]
+            trips = trip_count(counted, start, bound, FULL_UNROLL_TRIPS)
+        if trips and trips * size <= budget:
+            unroll_fully(cfg, loop, names, counted, trips)
+            budget -= trips * size
+        elif trips is None and factor > 1 and factor * size <= budget:
+            if not unroll_partially(cfg, loop, names, counted, factor, consts):
+                continue
+            budget -= factor * size
+        else:
+            continue
+        unrolled += 1
+        loops, consts, uses = cfg.loops(), constants(cfg), use_counts(cfg)
+    return unrolled
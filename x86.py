@@ -0,0 +1,271 @@
+"""
+The x86 IR that lowering emits. Nodes are immutable and use slots, and
+operators and operands are shared: an operator class has one instance,
+`set_cc` hands out one Set per condition code, and immediates and memory
+operands, which are AT&T strings, go through cached constructors so equal
+operands are one object. Registers are plain strings such as "%rax" with no
+register objects: they are written as constants, so no instruction
+allocates one, and the peephole rules match operands as text.
+"""
+
+from dataclasses import dataclass, field
+from functools import cache, lru_cache
+
+
+@dataclass(slots=True, frozen=True)
+class Instruction:
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Label(Instruction):
+    name: str
+
+
+@dataclass(slots=True, frozen=True)
+class Jump(Instruction):
+    target: int
+
+
+@dataclass(slots=True, frozen=True)
+class JumpCond(Instruction):
+    cond_code: str
+    label: str
+
+
+@dataclass(slots=True, frozen=True)
+class Mov(Instruction):
+    t: str
+    src: str
+    dest: str
+
+
+@dataclass(slots=True, frozen=True)
+class Cmov(Instruction):
+    cond_code: str
+    src: str
+    dest: str
+
+
+@dataclass(slots=True, frozen=True)
+class Push(Instruction):
+    t: str
+    reg: str
+
+
+@dataclass(slots=True, frozen=True)
+class Pop(Instruction):
+    t: str
+    reg: str
+
+
+@dataclass(slots=True, frozen=True)
+class Ret(Instruction):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Operator:
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Neg(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Not(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Xor(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Add(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Sub(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Mul(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Cmp(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Set(Operator):
+    code: str
+
+
+@dataclass(slots=True, frozen=True)
+class Test(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Unary(Instruction):
+    unary_operator: Operator
+    operand: str
+
+
+@dataclass(slots=True, frozen=True)
+class Binary(Instruction):
+    binary_operator: str
+    src: str
+    dest: str
+
+
+@dataclass(slots=True, frozen=True)
+class Call(Instruction):
+    t: str
+    name: str
+
+
+@dataclass(slots=True, frozen=True)
+class TailCall(Instruction):
+    name: str
+
+
+@dataclass(slots=True, frozen=True)
+class Div(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class And(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Or(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Sar(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Shl(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Shr(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Addsd(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Subsd(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Mulsd(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Divsd(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Ucomisd(Operator):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class Lea(Instruction):
+    src: str
+    dest: str
+
+
+@dataclass(slots=True, frozen=True)
+class AllocateStack(Instruction):
+    num: int
+
+
+@dataclass(slots=True, frozen=True)
+class DeallocateStack(Instruction):
+    num: int
+
+
+@dataclass(slots=True, frozen=True)
+class Cqo(Instruction):
+    pass
+
+
+@dataclass(slots=True)
+class Function:
+    name: str
+    instructions: list[Instruction]
+
+
+@dataclass(slots=True)
+class Program:
+    functions: list[Function]
+    # bit pattern of a float constant -> label of its pool entry
+    literals: dict[int, str] = field(default_factory=dict)
+
+
+NEG = Neg()
+NOT = Not()
+XOR = Xor()
+ADD = Add()
+SUB = Sub()
+MUL = Mul()
+DIV = Div()
+AND = And()
+OR = Or()
+SAR = Sar()
+SHL = Shl()
+SHR = Shr()
+CMP = Cmp()
+TEST = Test()
+ADDSD = Addsd()
+SUBSD = Subsd()
+MULSD = Mulsd()
+DIVSD = Divsd()
+UCOMISD = Ucomisd()
+
+
+@cache
+def set_cc(code: str) -> Set:
+    return Set(code)
+
+
+# bounded, since a resident compiler sees arbitrarily many constants
+@lru_cache(maxsize=1 << 12)
+def immediate(val) -> str:
+    return f"${val}"
+
+
+@lru_cache(maxsize=1 << 12)
+def stack_slot(offset: int) -> str:
+    return f"{offset}(%rsp)"
+
+
+@lru_cache(maxsize=1 << 12)
+def memory(base: str, index: str = None, scale: int = 8, offset: int = 0) -> str:
+    """offset(base) or offset(base,index,scale), without a zero offset."""
+    inner = base if index is None else f"{base},{index},{scale}"
+    return f"{offset or ''}({inner})"